@@ -0,0 +1,132 @@
+"""
+Regression check of the sampled previews (`HeatmapData(..., sample=...)` and
+`aggregate.estimate_heatmap`): on a synthetic course, the confidence
+intervals of the estimated heatmaps must contain the true counts at about
+their nominal rate, and be exact (zero-width) for a full sample.
+
+    python benchmarks/estimate_coverage.py [--fraction F] [--seeds N] ...
+
+The course is loaded once from `mock_api.MockAPI`; the samples are then
+drawn from its comments, like `HeatmapData.stream_rubric` does. Exits with
+a non-zero status on regression.
+"""
+
+# Python dependencies
+#
+from __future__ import print_function # Python 2
+#
+import argparse as argparse
+import itertools as itertools
+import os as os
+import random as random
+import sys as sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Local dependencies
+#
+import mock_api as mock_api
+import heatmap.preprocess as _preprocess
+import heatmap.aggregate as _aggregate
+
+#########################################################################
+
+
+DEFAULT_FRACTION = 0.3
+DEFAULT_SEEDS = 15
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_TOLERANCE = 0.05  # Below the nominal coverage
+
+#########################################################################
+
+
+def _preview(full, strata, sample):
+    # A `HeatmapData` holding a stratified sample of the comments of `full`
+    comments = full._map_comments_id_to_cache
+    hmapdata = _preprocess.HeatmapData(
+        full._assignment_id, api_key="x", cache=False, journal=False, load=False)
+    hmapdata._map_comments_id_to_cache = dict(
+        (comment_id, comments[comment_id])
+        for (comment_id, _) in full._sample_tasks(strata, sample))
+    hmapdata._invalidate()
+    return hmapdata
+
+def _coverage(full, preview, axes, section_to_teacher, confidence):
+    # Number of cells, and of cells whose interval contains the true count
+    (n_cells, n_covered) = (0, 0)
+    for (x, y) in axes:
+        truth = _aggregate.build_heatmap_matrix(
+            full, x=x, y=y, section_to_teacher=section_to_teacher).to_dict()
+        estimate = _aggregate.estimate_heatmap(
+            preview, x=x, y=y, section_to_teacher=section_to_teacher, confidence=confidence)
+        for (i, row_label) in enumerate(estimate.row_labels):
+            for (j, col_label) in enumerate(estimate.col_labels):
+                count = truth.get(col_label, {}).get(row_label, 0)
+                n_cells += 1
+                n_covered += int(estimate.lower[i, j] <= count <= estimate.upper[i, j])
+    return (n_cells, n_covered)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--fraction", type=float, default=DEFAULT_FRACTION,
+                        help="sampled fraction of the comments")
+    parser.add_argument("--seeds", type=int, default=DEFAULT_SEEDS,
+                        help="number of samples")
+    parser.add_argument("--confidence", type=float, default=DEFAULT_CONFIDENCE)
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="accepted shortfall of the coverage")
+    mock_api.add_course_arguments(parser)
+    parser.set_defaults(students=400, graders=6, sections=4)
+    args = parser.parse_args(argv)
+
+    course = mock_api.course_from_arguments(args)
+    assignment_id = course.assignment_ids[0]
+    section_to_teacher = course.section_to_teacher()
+    axes = list(itertools.product(_aggregate.HeatmapXAxis, _aggregate.HeatmapYAxis))
+
+    with mock_api.MockAPI(course) as mock:
+        full = _preprocess.HeatmapData(
+            assignment_id, api_key="x", cache=False, journal=False, base_url=mock.base_url)
+
+    # The strata, as in the rubric of the comments
+    strata = {}
+    for (_, comment_obj) in full.iter_comments():
+        rubricComment_obj = comment_obj["rubricComment"]
+        strata[rubricComment_obj["id"]] = (rubricComment_obj, rubricComment_obj["comments"])
+    strata = list(strata.values())
+
+    errors = []
+
+    # A full sample is exact
+    preview = _preview(full, strata, 1.0)
+    for (x, y) in axes:
+        estimate = _aggregate.estimate_heatmap(
+            preview, x=x, y=y, section_to_teacher=section_to_teacher)
+        if (estimate.upper != estimate.lower).any() or (estimate.stderr != 0).any():
+            errors.append("intervals of a full sample are not exact ({}, {})".format(
+                x.value, y.value))
+
+    (n_cells, n_covered) = (0, 0)
+    for seed in range(args.seeds):
+        random.seed(seed)
+        preview = _preview(full, strata, args.fraction)
+        (cells, covered) = _coverage(full, preview, axes, section_to_teacher, args.confidence)
+        n_cells += cells
+        n_covered += covered
+
+    coverage = float(n_covered) / max(1, n_cells)
+    print("coverage: {:.3f} of {} cells (nominal: {:.3f}, fraction: {})".format(
+        coverage, n_cells, args.confidence, args.fraction))
+    if coverage < args.confidence - args.tolerance:
+        errors.append("coverage {:.3f} below {:.3f}".format(
+            coverage, args.confidence - args.tolerance))
+
+    for error in errors:
+        print("FAIL: {}".format(error))
+
+    return 1 if len(errors) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
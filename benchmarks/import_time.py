@@ -0,0 +1,84 @@
+"""
+Import-time regression check: `import heatmap` (and the data-loading API in
+`heatmap.preprocess`) must not import the plotting and data analysis
+libraries, nor take longer than a time budget.
+
+    python benchmarks/import_time.py [--budget SECONDS]
+
+Exits with a non-zero status on regression.
+"""
+
+# Python dependencies
+#
+from __future__ import print_function # Python 2
+#
+import argparse as argparse
+import json as json
+import os as os
+import subprocess as subprocess
+import sys as sys
+
+#########################################################################
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Modules which should only be imported on first use of the draw API
+HEAVY_MODULES = ["numpy", "pandas", "seaborn", "matplotlib", "scipy"]
+
+DEFAULT_BUDGET = 1.0  # Seconds
+
+_PROBE = """
+import json, logging, sys, time
+t_start = time.time()
+import heatmap
+import heatmap.preprocess
+t_end = time.time()
+print(json.dumps({
+    "duration": t_end - t_start,
+    "modules": sorted(m for m in sys.modules if m.split(".")[0] in %r),
+    "root_handlers": len(logging.getLogger().handlers),
+    "handlers": [ type(h).__name__ for h in logging.getLogger("heatmap").handlers ],
+    "propagate": logging.getLogger("heatmap").propagate,
+}))
+"""
+
+#########################################################################
+
+
+def measure():
+    # Measured in a fresh interpreter, so that nothing is already imported
+    output = subprocess.check_output(
+        [sys.executable, "-c", _PROBE % (HEAVY_MODULES,)],
+        cwd=ROOT)
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET,
+                        help="maximum import time, in seconds")
+    args = parser.parse_args(argv)
+
+    result = measure()
+    print("import heatmap: {:.3f}s".format(result["duration"]))
+
+    errors = []
+    if len(result["modules"]) > 0:
+        errors.append("heavy modules imported: {}".format(
+            ", ".join(sorted(set(m.split(".")[0] for m in result["modules"])))))
+    if result["root_handlers"] > 0:
+        errors.append("logging handlers added to the root logger")
+    if result["handlers"] != ["NullHandler"] or not result["propagate"]:
+        errors.append("logging of the package configured on import: {}".format(
+            ", ".join(result["handlers"]) or "no handler"))
+    if result["duration"] > args.budget:
+        errors.append("import took {:.3f}s (budget: {:.3f}s)".format(
+            result["duration"], args.budget))
+
+    for error in errors:
+        print("FAIL: {}".format(error))
+
+    return 1 if len(errors) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,373 @@
+"""
+Local stand-in for the codePost API, serving a synthetic course: the
+`/assignments/`, `/rubric/`, `/courses/`, `/sections/`, `/comments/`,
+`/files/` and `/submissions/` endpoints used by `HeatmapData`, with an
+optional latency and rate of throttled (429) responses.
+
+    python benchmarks/mock_api.py [--port PORT] [--students N] ...
+
+serves until interrupted; point `HeatmapData(..., base_url=...)` at it.
+"""
+
+# Python dependencies
+#
+from __future__ import print_function # Python 2
+#
+import argparse as argparse
+import hashlib as hashlib
+import json as json
+import random as random
+import re as re
+import threading as threading
+import time as time
+
+try:
+    import http.server as _http_server
+except ImportError: # Python 2
+    import BaseHTTPServer as _http_server
+
+try:
+    import socketserver as _socketserver
+except ImportError: # Python 2
+    import SocketServer as _socketserver
+
+#########################################################################
+
+
+COURSE_ID = 1
+ASSIGNMENT_ID_START = 100
+
+#########################################################################
+
+
+class SyntheticCourse(object):
+    """
+    A synthetic course of `students` students split into `sections` sections,
+    with `assignments` assignments graded by `graders` graders, each with a
+    rubric of `rubric_comments` comments in `categories` categories. Every
+    submission has `files` files and receives between 0 and
+    `2 * comments_per_submission` comments (deterministic for a given `seed`).
+    """
+
+    def __init__(self, students=100, sections=5, graders=8, assignments=1,
+                 rubric_comments=20, categories=4, files=2, comments_per_submission=3,
+                 seed=0):
+        rnd = random.Random(seed)
+
+        self.parameters = {
+            "students": students, "sections": sections, "graders": graders,
+            "assignments": assignments, "rubric_comments": rubric_comments,
+            "categories": categories, "files": files,
+            "comments_per_submission": comments_per_submission, "seed": seed,
+        }
+
+        self.students = [ "student{}@example.edu".format(i) for i in range(students) ]
+        self.graders = [ "grader{}@example.edu".format(i) for i in range(graders) ]
+
+        self.sections = {}
+        for k in range(sections):
+            section_id = 10 + k
+            self.sections[section_id] = {
+                "id": section_id,
+                "name": "Section {:02d}".format(k),
+                "course": COURSE_ID,
+                "students": self.students[k::sections],
+                "leaders": [ self.graders[k % graders] ],
+            }
+
+        self.assignment_ids = [ ASSIGNMENT_ID_START + a for a in range(assignments) ]
+        self.course = {
+            "id": COURSE_ID,
+            "name": "Synthetic Course",
+            "sections": sorted(self.sections),
+            "assignments": list(self.assignment_ids),
+        }
+
+        self.assignments = {}
+        self.rubrics = {}
+        self.submissions = {}
+        self.submissions_by_assignment = {}
+        self.files = {}
+        self.comments = {}
+
+        (next_id, file_id, comment_id) = (1000, 100000, 1000000)
+        for assignment_id in self.assignment_ids:
+            self.assignments[assignment_id] = {
+                "id": assignment_id,
+                "name": "Assignment {}".format(assignment_id),
+                "course": COURSE_ID,
+                "points": 100,
+            }
+
+            rubricCategories = []
+            for c in range(categories):
+                rubricCategories.append({
+                    "id": next_id,
+                    "name": "Category {}".format(c),
+                    "assignment": assignment_id,
+                    "rubricComments": [],
+                    "sortKey": c,
+                })
+                next_id += 1
+
+            rubricComments = []
+            for r in range(rubric_comments):
+                rubricCategory_obj = rubricCategories[r % categories]
+                rubricComment_obj = {
+                    "id": next_id,
+                    "text": "Rubric comment {}".format(r),
+                    "pointDelta": float(rnd.randint(1, 5)),
+                    "category": rubricCategory_obj["id"],
+                    "comments": [],
+                    "sortKey": r,
+                }
+                rubricCategory_obj["rubricComments"].append(next_id)
+                rubricComments.append(rubricComment_obj)
+                next_id += 1
+
+            self.rubrics[assignment_id] = {
+                "rubricCategories": rubricCategories,
+                "rubricComments": rubricComments,
+            }
+
+            self.submissions_by_assignment[assignment_id] = []
+            for student in self.students:
+                submission_id = next_id
+                next_id += 1
+
+                file_ids = []
+                for _ in range(files):
+                    self.files[file_id] = {
+                        "id": file_id,
+                        "name": "file{}.py".format(len(file_ids)),
+                        "submission": submission_id,
+                    }
+                    file_ids.append(file_id)
+                    file_id += 1
+
+                submission_obj = {
+                    "id": submission_id,
+                    "assignment": assignment_id,
+                    "students": [ student ],
+                    "grader": rnd.choice(self.graders),
+                    "files": file_ids,
+                    "grade": 100,
+                }
+                self.submissions[submission_id] = submission_obj
+                self.submissions_by_assignment[assignment_id].append(submission_obj)
+
+                for _ in range(rnd.randint(0, 2 * comments_per_submission)):
+                    rubricComment_obj = rnd.choice(rubricComments)
+                    self.comments[comment_id] = {
+                        "id": comment_id,
+                        "text": "",
+                        "file": rnd.choice(file_ids),
+                        "rubricComment": rubricComment_obj["id"],
+                        "author": submission_obj["grader"],
+                        "pointDelta": None,
+                        "startChar": 0,
+                        "endChar": 10,
+                        "startLine": 0,
+                        "endLine": 0,
+                    }
+                    rubricComment_obj["comments"].append(comment_id)
+                    comment_id += 1
+
+    @property
+    def comment_count(self):
+        return len(self.comments)
+
+    def section_to_teacher(self):
+        """
+        Return the map of section names to their (first) leader, as expected
+        by `build_heatmap`.
+        """
+        return dict(
+            (section_obj["name"], section_obj["leaders"][0])
+            for section_obj in self.sections.values())
+
+    def resolve(self, path):
+        """
+        Return the object served at `path`, or `None` if there is none.
+        """
+        match = re.match(r"^/(\w+)/(\d+)/(?:(\w+)/)?$", path.split("?")[0])
+        if match == None:
+            return None
+
+        (kind, object_id, subresource) = (match.group(1), int(match.group(2)), match.group(3))
+
+        if kind == "assignments":
+            if subresource == "rubric":
+                return self.rubrics.get(object_id)
+            if subresource == "submissions":
+                return self.submissions_by_assignment.get(object_id)
+            if subresource == None:
+                return self.assignments.get(object_id)
+            return None
+
+        if subresource != None:
+            return None
+
+        if kind == "courses":
+            return self.course if object_id == COURSE_ID else None
+
+        objects = {
+            "sections": self.sections,
+            "comments": self.comments,
+            "files": self.files,
+            "submissions": self.submissions,
+        }.get(kind)
+
+        return objects.get(object_id) if objects != None else None
+
+#########################################################################
+
+
+class _ThreadingHTTPServer(_socketserver.ThreadingMixIn, _http_server.HTTPServer):
+    daemon_threads = True
+    # The default backlog is too small for the concurrent fetches
+    request_queue_size = 128
+
+class MockAPI(object):
+    """
+    HTTP server (in a background thread) serving `course` on
+    `http://127.0.0.1:<port>/`, waiting `latency` seconds before each
+    response and throttling a fraction `throttle_rate` of the requests.
+    Responses have an `ETag`, and conditional requests (`If-None-Match`)
+    are answered with 304 if the object did not change.
+
+    Usable as a context manager.
+    """
+
+    def __init__(self, course, latency=0.0, throttle_rate=0.0, port=0, seed=0):
+        self.course = course
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+
+        mock = self
+
+        class Handler(_http_server.BaseHTTPRequestHandler):
+            # Keep-alive, so that connection pooling is measured as well
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                mock._handle(self)
+
+        self._server = _ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:{}/".format(self.port)
+
+    def _handle(self, handler):
+        with self._lock:
+            self.requests += 1
+            throttled = self._random.random() < self.throttle_rate
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if throttled:
+            handler.send_response(429)
+            handler.send_header("Retry-After", "0.05")
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+
+        obj = self.course.resolve(handler.path)
+        if obj == None:
+            body = json.dumps({"detail": "Not found."}).encode("utf-8")
+            handler.send_response(404)
+        else:
+            body = json.dumps(obj).encode("utf-8")
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            if handler.headers.get("If-None-Match") == etag:
+                handler.send_response(304)
+                handler.send_header("ETag", etag)
+                handler.send_header("Content-Length", "0")
+                handler.end_headers()
+                return
+            handler.send_response(200)
+            handler.send_header("ETag", etag)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+#########################################################################
+
+
+def add_course_arguments(parser):
+    parser.add_argument("--students", type=int, default=100)
+    parser.add_argument("--sections", type=int, default=5)
+    parser.add_argument("--graders", type=int, default=8)
+    parser.add_argument("--assignments", type=int, default=1)
+    parser.add_argument("--rubric-comments", type=int, default=20)
+    parser.add_argument("--categories", type=int, default=4)
+    parser.add_argument("--files", type=int, default=2)
+    parser.add_argument("--comments-per-submission", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="delay before each response, in seconds")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="fraction of the requests answered with 429")
+
+def course_from_arguments(args):
+    return SyntheticCourse(
+        students=args.students,
+        sections=args.sections,
+        graders=args.graders,
+        assignments=args.assignments,
+        rubric_comments=args.rubric_comments,
+        categories=args.categories,
+        files=args.files,
+        comments_per_submission=args.comments_per_submission,
+        seed=args.seed)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8000)
+    add_course_arguments(parser)
+    args = parser.parse_args(argv)
+
+    course = course_from_arguments(args)
+    mock = MockAPI(course, latency=args.latency, throttle_rate=args.throttle_rate,
+                   port=args.port)
+    print("Serving {} comments of assignments {} on {}".format(
+        course.comment_count, course.assignment_ids, mock.base_url))
+    try:
+        mock._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock._server.server_close()
+
+if __name__ == "__main__":
+    main()
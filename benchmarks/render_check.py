@@ -0,0 +1,81 @@
+"""
+Regression check of the rendering of edge-case heatmaps: the delta of two
+identical snapshots (the most common diff) and heatmaps without comments
+must export to every format, as a figure saying so, rather than fail.
+
+    python benchmarks/render_check.py
+
+Exits with a non-zero status on regression.
+"""
+
+# Python dependencies
+#
+from __future__ import print_function # Python 2
+#
+import os as os
+import sys as sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+# Draw without a display (must be set before pyplot is imported)
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+# Local dependencies
+#
+import heatmap.aggregate as _aggregate
+import heatmap.draw as _draw
+import heatmap.snapshot as _snapshot
+
+#########################################################################
+
+
+def _comments():
+    # A few enriched comments, as loaded by `HeatmapData`
+    comments = []
+    for (comment_id, author, rubric_comment_id, section) in [
+            (1, "grader0@example.edu", 10, "Section 00"),
+            (2, "grader1@example.edu", 10, "Section 01"),
+            (3, "grader1@example.edu", 11, "Section 01")]:
+        comments.append((comment_id, {
+            "author": author,
+            "rubricComment": {"id": rubric_comment_id,
+                              "text": "Rubric comment {}".format(rubric_comment_id)},
+            "category": "Category 0",
+            "sections": [section],
+        }))
+    return comments
+
+def _cases():
+    codes = _aggregate.CommentCodes.from_comments(_comments())
+    old = _snapshot.Snapshot(codes, assignment_id=100)
+    new = _snapshot.Snapshot(codes, assignment_id=100)
+    no_codes = _aggregate.CommentCodes.from_comments([])
+
+    return [
+        ("identical snapshots", _snapshot.diff(old, new).delta(), True),
+        ("identical snapshots (sparse)", _snapshot.diff(old, new).delta(sparse=True), True),
+        ("no comments", _aggregate.build_heatmap_matrix(no_codes), False),
+        ("no comments (dict)", {}, False),
+        ("comments", old.heatmap(), False),
+    ]
+
+def main(argv=None):
+    errors = []
+    for (name, data, diverging) in _cases():
+        for format in _draw.EXPORT_FORMATS:
+            try:
+                image = _draw.export_heatmap(data, format=format, diverging=diverging)
+                if not isinstance(image, bytes) or len(image) == 0:
+                    errors.append("{} ({}): no image".format(name, format))
+            except Exception as exc:
+                errors.append("{} ({}): {!r}".format(name, format, exc))
+
+    print("rendered {} cases".format(len(_cases())))
+    for error in errors:
+        print("FAIL: {}".format(error))
+
+    return 1 if len(errors) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,264 @@
+"""
+Performance benchmarks of `heatmap` against a local mock codePost API (see
+`mock_api.py`): cold initialization of `HeatmapData`, cache store and load,
+`build_heatmap` for every axis combination, and rendering.
+
+    python benchmarks/run.py [--students N] [--latency SECONDS] ...
+
+Each run is appended to a results file (one JSON object per line, with the
+version and parameters), and compared with the latest previous run with the
+same parameters. Exits with a non-zero status on regression if
+`--fail-on-regression` is given.
+"""
+
+# Python dependencies
+#
+from __future__ import print_function # Python 2
+#
+import argparse as argparse
+import datetime as datetime
+import itertools as itertools
+import json as json
+import os as os
+import platform as platform
+import shutil as shutil
+import subprocess as subprocess
+import sys as sys
+import tempfile as tempfile
+import time as time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Draw without a display (must be set before pyplot is imported)
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+# Local dependencies
+#
+import mock_api as mock_api
+
+#########################################################################
+
+
+DEFAULT_RESULTS_FILENAME = os.path.join(ROOT, "benchmarks", "results.jsonl")
+
+DEFAULT_REPEAT = 3
+
+# A benchmark is a regression if it is slower than in the previous run by
+# more than this factor (timings below `MIN_DURATION` are too noisy)
+DEFAULT_THRESHOLD = 1.25
+MIN_DURATION = 0.005  # Seconds
+
+#########################################################################
+
+
+def version():
+    """
+    Return the version being benchmarked: the git revision of the tree (with
+    a "-dirty" suffix for uncommitted changes), or "unknown".
+    """
+    try:
+        output = subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=ROOT, stderr=subprocess.STDOUT)
+        return output.decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def timed(func, repeat=1):
+    """
+    Call `func()` `repeat` times; return the best duration (in seconds) and
+    the result of the last call.
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        t_start = time.time()
+        result = func()
+        duration = time.time() - t_start
+        best = duration if best == None else min(best, duration)
+    return (best, result)
+
+#########################################################################
+
+
+def run_benchmarks(course, base_url, args):
+    import heatmap as heatmap
+    import heatmap.draw as draw
+    import matplotlib.pyplot as plt
+
+    assignment_id = course.assignment_ids[0]
+    section_to_teacher = course.section_to_teacher()
+    results = {}
+
+    def make_data(**kwargs):
+        return heatmap.preprocess.HeatmapData(
+            assignment_id, cache=False, api_key="benchmark", base_url=base_url,
+            max_workers=args.max_workers, rate_limit=args.rate_limit, **kwargs)
+
+    # Initialization (the memo is cleared by every run)
+    (results["init_cold"], hmapdata) = timed(make_data, args.repeat)
+    (results["init_cold_prefetch"], _) = timed(
+        lambda: make_data(prefetch=True), args.repeat)
+    results["init_requests"] = hmapdata.stats()["counters"]["get_total"]
+
+    # Cache
+    directory = tempfile.mkdtemp(prefix="heatmap_benchmark_")
+    try:
+        filename = os.path.join(directory, "cache.json")
+        (results["cache_store"], _) = timed(
+            lambda: hmapdata._store_cache(filename=filename), args.repeat)
+        results["cache_bytes"] = os.path.getsize(filename)
+
+        def load():
+            loaded = make_data(load=False)
+            loaded._load_cache(filename=filename)
+            return loaded
+        (results["cache_load"], loaded) = timed(load, args.repeat)
+        if len(loaded.view_comments()) != len(hmapdata.view_comments()):
+            raise Exception("Benchmark error: the cache was not loaded.")
+    finally:
+        shutil.rmtree(directory)
+
+    # Aggregation, for every axis combination and heatmap format (the
+    # vectorized formats are measured both cold and with derived data cached)
+    heatmaps = {}
+    for (x, y) in itertools.product(draw.HeatmapXAxis, draw.HeatmapYAxis):
+        name = "{}_{}".format(x.value, y.value)
+        build = lambda format: draw.build_heatmap(
+            hmapdata, x=x, y=y, section_to_teacher=section_to_teacher, format=format)
+
+        (results["build_dict_" + name], heatmaps[(x, y)]) = timed(
+            lambda: build("dict"), args.repeat)
+
+        def build_cold(format):
+            hmapdata._invalidate()
+            return build(format)
+        for format in ("matrix", "sparse"):
+            (results["build_{}_cold_{}".format(format, name)], _) = timed(
+                lambda: build_cold(format), args.repeat)
+            (results["build_{}_{}".format(format, name)], _) = timed(
+                lambda: build(format), args.repeat)
+
+    # Rendering (the largest heatmap)
+    data = heatmaps[(draw.HeatmapXAxis.GRADERS, draw.HeatmapYAxis.COMMENTS)]
+
+    def render():
+        draw.render_heatmap_data(data)
+        plt.close("all")
+    (results["render"], _) = timed(render, args.repeat)
+    (results["export_png"], _) = timed(
+        lambda: draw.export_heatmap(data, format="png"), args.repeat)
+    (results["export_svg"], _) = timed(
+        lambda: draw.export_heatmap(data, format="svg"), args.repeat)
+
+    return results
+
+#########################################################################
+
+
+def load_results(filename):
+    records = []
+    if not os.path.exists(filename):
+        return records
+    with open(filename) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+def compare(record, previous, threshold):
+    """
+    Print the results of `record` next to those of `previous` (if any), and
+    return the names of the benchmarks which regressed.
+    """
+    regressions = []
+    print("{:<52} {:>10} {:>10} {:>7}".format(
+        "benchmark", "seconds", "previous", "ratio"))
+
+    for (name, value) in sorted(record["results"].items()):
+        if not isinstance(value, float):
+            print("{:<52} {:>10}".format(name, value))
+            continue
+
+        old = (previous or {}).get("results", {}).get(name)
+        if not isinstance(old, float):
+            print("{:<52} {:>10.4f}".format(name, value))
+            continue
+
+        ratio = value / old if old > 0 else float("inf")
+        regressed = ratio > threshold and value > MIN_DURATION
+        print("{:<52} {:>10.4f} {:>10.4f} {:>6.2f}x{}".format(
+            name, value, old, ratio, " REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(name)
+
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    mock_api.add_course_arguments(parser)
+    parser.add_argument("--max-workers", type=int, default=8)
+    parser.add_argument("--rate-limit", type=float, default=1000.0,
+                        help="requests per second (the mock API is local)")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT,
+                        help="number of runs of each benchmark (the best is kept)")
+    parser.add_argument("--results", default=DEFAULT_RESULTS_FILENAME,
+                        help="file the results are appended to")
+    parser.add_argument("--no-record", action="store_true",
+                        help="do not append the results to the results file")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="slowdown factor considered a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args(argv)
+
+    course = mock_api.course_from_arguments(args)
+    parameters = dict(course.parameters)
+    parameters.update({
+        "latency": args.latency,
+        "throttle_rate": args.throttle_rate,
+        "max_workers": args.max_workers,
+        "rate_limit": args.rate_limit,
+        "repeat": args.repeat,
+    })
+
+    print("Benchmarking {} comments ({} students, latency {:.3f}s)".format(
+        course.comment_count, args.students, args.latency))
+
+    with mock_api.MockAPI(course, latency=args.latency,
+                          throttle_rate=args.throttle_rate) as mock:
+        results = run_benchmarks(course, mock.base_url, args)
+
+    record = {
+        "version": version(),
+        "date": datetime.datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "parameters": parameters,
+        "results": results,
+    }
+
+    # Compare with the latest run on the same synthetic course
+    previous = None
+    for candidate in load_results(args.results):
+        if candidate.get("parameters") == parameters:
+            previous = candidate
+    if previous != None:
+        print("Compared with version {} ({})".format(previous["version"], previous["date"]))
+
+    regressions = compare(record, previous, args.threshold)
+
+    if not args.no_record:
+        with open(args.results, "a") as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+
+    if len(regressions) > 0:
+        print("{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+        if args.fail_on_regression:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
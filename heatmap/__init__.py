@@ -1,3 +1,4 @@
+import importlib as _importlib
 
 from . import util
 
@@ -6,5 +7,18 @@ _logger = util.getLogger()
 _logger.debug("Pkg loading: Loading 'preprocess'...")
 from . import preprocess
 
-_logger.debug("Pkg loading: Loading 'draw'...")
-from . import draw
+_logger.debug("Pkg loading: Loading 'collection'...")
+from . import collection
+
+# These modules depend on numpy, pandas, seaborn and matplotlib, which take
+# a while to import: only load them on first access (e.g. `heatmap.draw`)
+_LAZY_MODULES = ["aggregate", "analytics", "archive", "draw", "server", "snapshot"]
+
+def __getattr__(name):
+    if name in _LAZY_MODULES:
+        _logger.debug("Pkg loading: Loading '{}'...".format(name))
+        return _importlib.import_module("." + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+def __dir__():
+    return sorted(list(globals().keys()) + _LAZY_MODULES)
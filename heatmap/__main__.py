@@ -0,0 +1,15 @@
+
+# Python dependencies
+#
+from __future__ import print_function # Python 2
+#
+import sys as sys
+
+# Local dependencies
+#
+from .cli import main as main
+
+#########################################################################
+
+
+sys.exit(main())
@@ -0,0 +1,954 @@
+
+# Python dependencies
+#
+from __future__ import print_function # Python 2
+#
+import hashlib as hashlib
+import json as json
+import statistics as statistics
+
+# External dependencies
+#
+import numpy as _np                # Vectorized counting
+
+# Local dependencies
+#
+from . import util as _util
+
+#########################################################################
+
+
+_logger = _util.getLogger()
+
+#########################################################################
+
+
+class HeatmapXAxis(_util.DocEnum):
+    """
+    Describes all possible selectable data points for the heatmap's x-axis.
+    """
+
+    GRADERS = "graders", """Individual graders."""
+    SECTIONS = "sections", """Course sections."""
+    TEACHERS = "sectionsLeaders", """Section leaders."""
+
+class HeatmapYAxis(_util.DocEnum):
+    """
+    Describes all possible selectable data points for the heatmap's y-axis.
+    """
+
+    COMMENTS = "rubricComments", """Individual rubric comments (caption, ID)."""
+    CATEGORIES = "rubricCategories", """Rubric categories (caption)."""
+
+def axis_from_value(axis_class, value):
+    """
+    Return the member of `axis_class` (`HeatmapXAxis` or `HeatmapYAxis`)
+    with the given value (e.g. "graders").
+    """
+    # `DocEnum` members cannot be looked up by value
+    for axis in axis_class:
+        if axis.value == value:
+            return axis
+    raise ValueError("Unknown axis: {} (expected one of {})".format(
+        value, ", ".join(axis.value for axis in axis_class)))
+
+#########################################################################
+
+
+def comment_keys(comment_obj, x, section_to_teacher=None):
+    """
+    Return the list of x-axis keys of an enriched comment.
+    """
+    # Keys must be plural to support sections (multiple per assignment
+    # since students from different sections could partner)
+    if x == HeatmapXAxis.GRADERS:
+        return [ comment_obj["author"] ]
+
+    if x == HeatmapXAxis.SECTIONS:
+        return comment_obj["sections"]
+
+    if x == HeatmapXAxis.TEACHERS:
+
+        if section_to_teacher == None:
+            raise ValueError(
+                "'section_to_teacher' needs to be defined for TEACHERS")
+
+        # Resolve the teachers from the sections
+        return list(set(
+            map(lambda s: section_to_teacher.get(s, ""),
+                comment_obj["sections"])))
+
+    return []
+
+def comment_value(comment_obj, y):
+    """
+    Return the y-axis key of an enriched comment.
+    """
+    if y == HeatmapYAxis.COMMENTS:
+        rubricComment_obj = comment_obj["rubricComment"]
+        return (rubricComment_obj["text"], rubricComment_obj["id"])
+
+    if y == HeatmapYAxis.CATEGORIES:
+        return comment_obj["category"]
+
+    return None
+
+class HeatmapAccumulator(object):
+    """
+    Incrementally counts comments by x-axis and y-axis key, for instance
+    while they are streamed by `HeatmapData.stream`, so that partial heatmaps
+    are available at any time.
+    """
+
+    def __init__(self, x=HeatmapXAxis.GRADERS, y=HeatmapYAxis.COMMENTS, section_to_teacher=None):
+        if x == HeatmapXAxis.TEACHERS and section_to_teacher == None:
+            raise ValueError(
+                "'section_to_teacher' needs to be defined for TEACHERS")
+
+        self._x = x
+        self._y = y
+        self._section_to_teacher = section_to_teacher
+        self._heatmap = {}
+        self._count = 0
+
+    def __len__(self):
+        # Number of comments added so far
+        return self._count
+
+    def add(self, comment_obj):
+        value = comment_value(comment_obj, self._y)
+
+        # Insert in heatmap assuming multiple keys (typically only one)
+        for key in comment_keys(comment_obj, self._x, self._section_to_teacher):
+            column = self._heatmap.setdefault(key, {})
+            column[value] = column.get(value, 0) + 1
+
+        self._count += 1
+
+    def update(self, comments):
+        """
+        Add an iterable of `(comment_id, comment_obj)` pairs.
+        """
+        for (_, comment_obj) in comments:
+            self.add(comment_obj)
+
+    def to_dict(self):
+        """
+        Return (a copy of) the heatmap so far, in the format of `build_heatmap`.
+        """
+        return dict(
+            (key, dict(column)) for (key, column) in self._heatmap.items())
+
+    def to_matrix(self):
+        row_labels, row_codes = [], {}
+        col_labels = list(self._heatmap.keys())
+        cells = []
+        for (j, column) in enumerate(self._heatmap.values()):
+            for (value, count) in column.items():
+                cells.append((_encode(row_labels, row_codes, value), j, count))
+
+        counts = _np.zeros((len(row_labels), len(col_labels)), dtype=_np.int64)
+        for (i, j, count) in cells:
+            counts[i, j] = count
+        return HeatmapMatrix(counts, row_labels, col_labels)
+
+#########################################################################
+
+
+def _encode(labels, codes, label):
+    # Assign codes to labels by order of first appearance
+    code = codes.get(label)
+    if code == None:
+        code = len(labels)
+        codes[label] = code
+        labels.append(label)
+    return code
+
+def _remap(labels, other_labels, codes):
+    # Array mapping the codes of `other_labels` to codes of the merged labels
+    return _np.array(
+        [ _encode(labels, codes, label) for label in other_labels ],
+        dtype=_np.int64)
+
+class CommentCodes(object):
+    """
+    Integer encoding of a set of enriched comments: each comment is
+    represented by its index in the arrays `comment_ids`, `grader`,
+    `rubric_comment` and `category`, whose values are indexes into the label
+    lists `graders`, `rubric_comments` (as `(text, id)` pairs) and
+    `categories`.
+
+    Since a comment may be linked to several sections (partners from
+    different sections), sections are encoded as pairs of arrays:
+    `section_comment` (index of the comment) and `section`.
+    """
+
+    def __init__(self, comment_ids, grader, rubric_comment, category,
+                 section_comment, section,
+                 graders, rubric_comments, categories, sections):
+        self.comment_ids = comment_ids
+        self.grader = grader
+        self.rubric_comment = rubric_comment
+        self.category = category
+        self.section_comment = section_comment
+        self.section = section
+        self.graders = graders
+        self.rubric_comments = rubric_comments
+        self.categories = categories
+        self.sections = sections
+
+    def __len__(self):
+        return len(self.comment_ids)
+
+    @classmethod
+    def from_comments(cls, comments):
+        """
+        Encode an iterable of `(comment_id, comment_obj)` pairs, such as
+        `HeatmapData.iter_comments()`.
+        """
+        graders, grader_codes = [], {}
+        rubric_comments, rubric_comment_codes = [], {}
+        categories, category_codes = [], {}
+        sections, section_codes = [], {}
+
+        comment_ids = []
+        grader = []
+        rubric_comment = []
+        category = []
+        section_comment = []
+        section = []
+
+        for (index, (comment_id, comment_obj)) in enumerate(comments):
+            rubricComment_obj = comment_obj["rubricComment"]
+
+            comment_ids.append(int(comment_id))
+            grader.append(_encode(graders, grader_codes, comment_obj["author"]))
+            rubric_comment.append(_encode(
+                rubric_comments, rubric_comment_codes,
+                (rubricComment_obj["text"], rubricComment_obj["id"])))
+            category.append(_encode(categories, category_codes, comment_obj["category"]))
+
+            for section_name in comment_obj["sections"]:
+                section_comment.append(index)
+                section.append(_encode(sections, section_codes, section_name))
+
+        return cls(
+            comment_ids=_np.array(comment_ids, dtype=_np.int64),
+            grader=_np.array(grader, dtype=_np.int64),
+            rubric_comment=_np.array(rubric_comment, dtype=_np.int64),
+            category=_np.array(category, dtype=_np.int64),
+            section_comment=_np.array(section_comment, dtype=_np.int64),
+            section=_np.array(section, dtype=_np.int64),
+            graders=graders,
+            rubric_comments=rubric_comments,
+            categories=categories,
+            sections=sections)
+
+    @classmethod
+    def concatenate(cls, codes_list):
+        """
+        Merge the encodings of several sets of comments (typically several
+        assignments), unifying their labels.
+        """
+        labels = dict(graders=[], rubric_comments=[], categories=[], sections=[])
+        label_codes = dict(graders={}, rubric_comments={}, categories={}, sections={})
+
+        arrays = dict(comment_ids=[], grader=[], rubric_comment=[], category=[],
+                      section_comment=[], section=[])
+        offset = 0
+
+        for codes in codes_list:
+            remap = dict(
+                (name, _remap(labels[name], getattr(codes, name), label_codes[name]))
+                for name in labels)
+
+            arrays["comment_ids"].append(codes.comment_ids)
+            arrays["grader"].append(remap["graders"][codes.grader])
+            arrays["rubric_comment"].append(remap["rubric_comments"][codes.rubric_comment])
+            arrays["category"].append(remap["categories"][codes.category])
+            arrays["section_comment"].append(codes.section_comment + offset)
+            arrays["section"].append(remap["sections"][codes.section])
+            offset += len(codes)
+
+        kwargs = dict(
+            (name, _np.concatenate(values) if len(values) > 0 else _np.zeros(0, dtype=_np.int64))
+            for (name, values) in arrays.items())
+        kwargs.update(labels)
+        return cls(**kwargs)
+
+    def take(self, indexes):
+        """
+        Return the encoding of the comments at the given indexes only (with
+        the same labels).
+        """
+        indexes = _np.asarray(indexes, dtype=_np.int64)
+        position = _np.full(len(self), -1, dtype=_np.int64)
+        position[indexes] = _np.arange(len(indexes), dtype=_np.int64)
+        section_comment = position[self.section_comment]
+        keep = section_comment >= 0
+        return CommentCodes(
+            comment_ids=self.comment_ids[indexes],
+            grader=self.grader[indexes],
+            rubric_comment=self.rubric_comment[indexes],
+            category=self.category[indexes],
+            section_comment=section_comment[keep],
+            section=self.section[keep],
+            graders=self.graders,
+            rubric_comments=self.rubric_comments,
+            categories=self.categories,
+            sections=self.sections)
+
+    def x_pairs(self, x, section_to_teacher=None):
+        """
+        Return `(comment_index, x_code, x_labels)`: the arrays of the
+        (comment, x-axis key) pairs to count, and the labels of the codes.
+        """
+        if x == HeatmapXAxis.GRADERS:
+            return (_np.arange(len(self), dtype=_np.int64), self.grader, self.graders)
+
+        if x == HeatmapXAxis.SECTIONS:
+            return (self.section_comment, self.section, self.sections)
+
+        if x == HeatmapXAxis.TEACHERS:
+            if section_to_teacher == None:
+                raise ValueError(
+                    "'section_to_teacher' needs to be defined for TEACHERS")
+
+            return teacher_pairs(
+                self.section_comment, self.section, self.sections, section_to_teacher)
+
+        raise ValueError("Unknown x-axis: {}".format(x))
+
+    def y_codes(self, y):
+        """
+        Return `(y_code, y_labels)`, where `y_code` gives the y-axis key of
+        each comment.
+        """
+        if y == HeatmapYAxis.COMMENTS:
+            return (self.rubric_comment, self.rubric_comments)
+
+        if y == HeatmapYAxis.CATEGORIES:
+            return (self.category, self.categories)
+
+        raise ValueError("Unknown y-axis: {}".format(y))
+
+def teacher_pairs(section_comment, section, sections, section_to_teacher):
+    """
+    Return `(comment_index, teacher_code, teachers)`: the (comment, teacher)
+    pairs of the (comment, section) pairs `section_comment` and `section`
+    (codes of the labels `sections`).
+    """
+    teachers, teacher_codes = [], {}
+    section_teacher = _np.array(
+        [ _encode(teachers, teacher_codes, section_to_teacher.get(s, ""))
+          for s in sections ],
+        dtype=_np.int64)
+
+    # A comment only counts once per teacher, even when it is linked to
+    # several sections of the same teacher
+    n_teachers = max(1, len(teachers))
+    keys = _np.unique(section_comment * n_teachers + section_teacher[section])
+    return (keys // n_teachers, keys % n_teachers, teachers)
+
+def comment_codes(hmapdata):
+    """
+    Return the `CommentCodes` of a `HeatmapData`, which are only computed
+    once (until its comments change).
+    """
+    codes = hmapdata._derived.get("codes")
+    if codes == None:
+        codes = CommentCodes.from_comments(hmapdata.iter_comments())
+        hmapdata._derived["codes"] = codes
+    return codes
+
+#########################################################################
+
+
+def _expand(owner, offsets, members):
+    # For each item `k`, one pair per member of the group `owner[k]`, whose
+    # members are `members[offsets[g]:offsets[g + 1]]`: returns the arrays
+    # of the items and members of these pairs
+    sizes = (offsets[1:] - offsets[:-1])[owner]
+    item = _np.repeat(_np.arange(len(owner), dtype=_np.int64), sizes)
+    starts = _np.repeat(offsets[owner], sizes)
+    within = _np.arange(len(item), dtype=_np.int64) - _np.repeat(_np.cumsum(sizes) - sizes, sizes)
+    return (item, members[starts + within])
+
+def _groups_to_csr(groups):
+    offsets = _np.zeros(len(groups) + 1, dtype=_np.int64)
+    offsets[1:] = _np.cumsum([ len(group) for group in groups ])
+    members = _np.array(
+        [ member for group in groups for member in group ], dtype=_np.int64)
+    return (offsets, members)
+
+class CommentCube(object):
+    """
+    Precomputed counts of the comments by grader, group of sections (the
+    sections of the students of the submission, usually just one) and rubric
+    comment; the category is a function of the rubric comment
+    (`rubric_category`). Only the non-zero cells are stored, as the arrays
+    `grader`, `group`, `rubric_comment` and `counts`.
+
+    Any heatmap (see `project`) is a projection of the cells, whose number
+    is at most the number of comments and typically much smaller, so that
+    changing axes or the `section_to_teacher` mapping does not require
+    scanning the comments again.
+    """
+
+    def __init__(self, grader, group, rubric_comment, counts,
+                 graders, sections, rubric_comments, categories, rubric_category, groups):
+        self.grader = _np.asarray(grader, dtype=_np.int64)
+        self.group = _np.asarray(group, dtype=_np.int64)
+        self.rubric_comment = _np.asarray(rubric_comment, dtype=_np.int64)
+        self.counts = _np.asarray(counts, dtype=_np.int64)
+        self.graders = list(graders)
+        self.sections = list(sections)
+        self.rubric_comments = list(rubric_comments)
+        self.categories = list(categories)
+        self.rubric_category = _np.asarray(rubric_category, dtype=_np.int64)
+        self.groups = [ tuple(group) for group in groups ]
+        (self._group_offsets, self._group_sections) = _groups_to_csr(self.groups)
+
+    def __len__(self):
+        # Number of non-zero cells
+        return len(self.counts)
+
+    @property
+    def total(self):
+        # Number of comments
+        return int(self.counts.sum())
+
+    @classmethod
+    def from_codes(cls, codes):
+        """
+        Build the cube of the comments encoded by `codes` (`CommentCodes`).
+        """
+        # Group of sections of each comment (as a sorted tuple of codes,
+        # keeping duplicates, which are counted twice like in `build_heatmap`)
+        comment_sections = [ [] for _ in range(len(codes)) ]
+        for (index, section) in zip(codes.section_comment.tolist(), codes.section.tolist()):
+            comment_sections[index].append(section)
+
+        groups, group_codes = [], {}
+        group = _np.array(
+            [ _encode(groups, group_codes, tuple(sorted(sections)))
+              for sections in comment_sections ],
+            dtype=_np.int64)
+
+        rubric_category = _np.zeros(len(codes.rubric_comments), dtype=_np.int64)
+        rubric_category[codes.rubric_comment] = codes.category
+
+        (n_groups, n_rubric) = (max(1, len(groups)), max(1, len(codes.rubric_comments)))
+        (keys, counts) = _np.unique(
+            (codes.grader * n_groups + group) * n_rubric + codes.rubric_comment,
+            return_counts=True)
+
+        return cls(
+            grader=keys // (n_groups * n_rubric),
+            group=(keys // n_rubric) % n_groups,
+            rubric_comment=keys % n_rubric,
+            counts=counts,
+            graders=codes.graders,
+            sections=codes.sections,
+            rubric_comments=codes.rubric_comments,
+            categories=codes.categories,
+            rubric_category=rubric_category,
+            groups=groups)
+
+    def to_state(self):
+        """
+        Return the cube as a JSON-serializable object (see `from_state`).
+        """
+        return {
+            "graders": self.graders,
+            "sections": self.sections,
+            "rubricComments": [ list(label) for label in self.rubric_comments ],
+            "categories": self.categories,
+            "rubricCategory": self.rubric_category.tolist(),
+            "groups": [ list(group) for group in self.groups ],
+            "cells": [
+                self.grader.tolist(),
+                self.group.tolist(),
+                self.rubric_comment.tolist(),
+                self.counts.tolist(),
+            ],
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        (grader, group, rubric_comment, counts) = state["cells"]
+        return cls(
+            grader=grader,
+            group=group,
+            rubric_comment=rubric_comment,
+            counts=counts,
+            graders=state["graders"],
+            sections=state["sections"],
+            rubric_comments=[ tuple(label) for label in state["rubricComments"] ],
+            categories=state["categories"],
+            rubric_category=state["rubricCategory"],
+            groups=state["groups"])
+
+    def x_pairs(self, x, section_to_teacher=None):
+        """
+        Return `(cell_index, x_code, x_labels)`: the arrays of the (cell,
+        x-axis key) pairs to count, and the labels of the codes.
+        """
+        if x == HeatmapXAxis.GRADERS:
+            return (_np.arange(len(self), dtype=_np.int64), self.grader, self.graders)
+
+        if x == HeatmapXAxis.SECTIONS:
+            (cell_index, section) = _expand(
+                self.group, self._group_offsets, self._group_sections)
+            return (cell_index, section, self.sections)
+
+        if x == HeatmapXAxis.TEACHERS:
+            if section_to_teacher == None:
+                raise ValueError(
+                    "'section_to_teacher' needs to be defined for TEACHERS")
+
+            # The teachers of each group (only once each): the roll-up is
+            # computed per group rather than per comment
+            teachers, teacher_codes = [], {}
+            group_teachers = []
+            for group in self.groups:
+                codes = set(
+                    _encode(teachers, teacher_codes, section_to_teacher.get(self.sections[s], ""))
+                    for s in group)
+                group_teachers.append(sorted(codes))
+
+            (offsets, members) = _groups_to_csr(group_teachers)
+            (cell_index, teacher) = _expand(self.group, offsets, members)
+            return (cell_index, teacher, teachers)
+
+        raise ValueError("Unknown x-axis: {}".format(x))
+
+    def y_codes(self, y):
+        """
+        Return `(y_code, y_labels)`, where `y_code` gives the y-axis key of
+        each cell.
+        """
+        if y == HeatmapYAxis.COMMENTS:
+            return (self.rubric_comment, self.rubric_comments)
+
+        if y == HeatmapYAxis.CATEGORIES:
+            return (self.rubric_category[self.rubric_comment], self.categories)
+
+        raise ValueError("Unknown y-axis: {}".format(y))
+
+    def project(self, x=HeatmapXAxis.GRADERS, y=HeatmapYAxis.COMMENTS,
+                section_to_teacher=None, sparse=False):
+        """
+        Return the heatmap of the comments for the given axes, like
+        `build_heatmap_matrix`.
+        """
+        (cell_index, x_code, x_labels) = self.x_pairs(x, section_to_teacher)
+        (y_code, y_labels) = self.y_codes(y)
+        return _heatmap_from_pairs(
+            y_code[cell_index], x_code, y_labels, x_labels,
+            weights=self.counts[cell_index], sparse=sparse)
+
+def comment_cube(hmapdata):
+    """
+    Return the `CommentCube` of a `HeatmapData`: loaded with its cache if it
+    was stored there, or else computed once (until its comments change).
+    """
+    cube = hmapdata._derived.get("cube")
+    if cube == None:
+        state = hmapdata._derived.get("cube_state")
+        if state != None:
+            cube = CommentCube.from_state(state)
+        else:
+            cube = CommentCube.from_codes(comment_codes(hmapdata))
+        hmapdata._derived["cube"] = cube
+    return cube
+
+#########################################################################
+
+
+def _digest(kind, row_labels, col_labels, arrays):
+    h = hashlib.sha256(kind.encode("utf-8"))
+    h.update(json.dumps([row_labels, col_labels], default=str).encode("utf-8"))
+    for array in arrays:
+        h.update(str(array.shape).encode("utf-8"))
+        h.update(_np.ascontiguousarray(array, dtype=_np.int64).tobytes())
+    return h.hexdigest()
+
+class HeatmapMatrix(object):
+    """
+    Dense heatmap: `counts[i, j]` is the number of comments with the y-axis
+    key `row_labels[i]` and the x-axis key `col_labels[j]`.
+    """
+
+    def __init__(self, counts, row_labels, col_labels):
+        self.counts = counts
+        self.row_labels = list(row_labels)
+        self.col_labels = list(col_labels)
+
+    @property
+    def shape(self):
+        return self.counts.shape
+
+    def to_dataframe(self):
+        import pandas as _pd
+        return _pd.DataFrame(
+            self.counts,
+            index=_pd.Index(self.row_labels),
+            columns=_pd.Index(self.col_labels))
+
+    def to_dict(self):
+        """
+        Return the heatmap in the format of `build_heatmap`, a map of x-axis
+        keys to maps of y-axis keys to (non-zero) counts.
+        """
+        heatmap = {}
+        (rows, cols) = _np.nonzero(self.counts)
+        for (i, j) in zip(rows.tolist(), cols.tolist()):
+            heatmap.setdefault(self.col_labels[j], {})[self.row_labels[i]] = int(self.counts[i, j])
+        return heatmap
+
+    def digest(self):
+        """
+        Return a hash of the labels and counts: two heatmaps with the same
+        digest render the same.
+        """
+        return _digest("dense", self.row_labels, self.col_labels, [self.counts])
+
+    def to_sparse(self):
+        (rows, cols) = _np.nonzero(self.counts)
+        return SparseHeatmapMatrix(
+            rows, cols, self.counts[rows, cols],
+            row_labels=self.row_labels, col_labels=self.col_labels)
+
+class SparseHeatmapMatrix(object):
+    """
+    Sparse heatmap (in coordinate format): for each `k`, there are `counts[k]`
+    comments with the y-axis key `row_labels[rows[k]]` and the x-axis key
+    `col_labels[cols[k]]`. Only the non-zero cells are stored.
+    """
+
+    def __init__(self, rows, cols, counts, row_labels, col_labels):
+        self.rows = _np.asarray(rows, dtype=_np.int64)
+        self.cols = _np.asarray(cols, dtype=_np.int64)
+        self.counts = _np.asarray(counts, dtype=_np.int64)
+        self.row_labels = list(row_labels)
+        self.col_labels = list(col_labels)
+
+    @property
+    def shape(self):
+        return (len(self.row_labels), len(self.col_labels))
+
+    @property
+    def nnz(self):
+        return len(self.counts)
+
+    def row_totals(self):
+        return _np.bincount(self.rows, weights=self.counts, minlength=self.shape[0]).astype(_np.int64)
+
+    def col_totals(self):
+        return _np.bincount(self.cols, weights=self.counts, minlength=self.shape[1]).astype(_np.int64)
+
+    def take(self, rows=None, cols=None):
+        """
+        Return the sub-matrix made of the given rows and columns (arrays of
+        indexes, in the order in which they should appear); `None` keeps all
+        of them.
+        """
+        (n_rows, n_cols) = self.shape
+        row_index = _np.arange(n_rows) if rows is None else _np.asarray(rows, dtype=_np.int64)
+        col_index = _np.arange(n_cols) if cols is None else _np.asarray(cols, dtype=_np.int64)
+
+        # Position of each old row/column in the sub-matrix (-1 if dropped)
+        row_map = _np.full(n_rows, -1, dtype=_np.int64)
+        row_map[row_index] = _np.arange(len(row_index))
+        col_map = _np.full(n_cols, -1, dtype=_np.int64)
+        col_map[col_index] = _np.arange(len(col_index))
+
+        new_rows = row_map[self.rows]
+        new_cols = col_map[self.cols]
+        keep = (new_rows >= 0) & (new_cols >= 0)
+
+        return SparseHeatmapMatrix(
+            new_rows[keep], new_cols[keep], self.counts[keep],
+            row_labels=[ self.row_labels[i] for i in row_index ],
+            col_labels=[ self.col_labels[j] for j in col_index ])
+
+    def select(self, row_labels=None, col_labels=None):
+        """
+        Like `take`, but with lists of labels rather than indexes.
+        """
+        rows = None
+        if row_labels != None:
+            codes = dict((label, i) for (i, label) in enumerate(self.row_labels))
+            rows = [ codes[label] for label in row_labels ]
+        cols = None
+        if col_labels != None:
+            codes = dict((label, j) for (j, label) in enumerate(self.col_labels))
+            cols = [ codes[label] for label in col_labels ]
+        return self.take(rows=rows, cols=cols)
+
+    def top(self, n_rows=None, n_cols=None):
+        """
+        Return the sub-matrix of the `n_rows` rows and `n_cols` columns with
+        the most comments (in decreasing order); `None` keeps all of them.
+        """
+        rows = None
+        if n_rows != None:
+            rows = _np.argsort(-self.row_totals(), kind="stable")[:n_rows]
+        cols = None
+        if n_cols != None:
+            cols = _np.argsort(-self.col_totals(), kind="stable")[:n_cols]
+        return self.take(rows=rows, cols=cols)
+
+    def digest(self):
+        """
+        Return a hash of the labels and (non-zero) cells, independent of the
+        order in which the cells are stored.
+        """
+        order = _np.lexsort((self.cols, self.rows))
+        return _digest("sparse", self.row_labels, self.col_labels,
+                       [self.rows[order], self.cols[order], self.counts[order]])
+
+    def to_dense(self):
+        counts = _np.zeros(self.shape, dtype=_np.int64)
+        _np.add.at(counts, (self.rows, self.cols), self.counts)
+        return HeatmapMatrix(counts, self.row_labels, self.col_labels)
+
+    def to_dataframe(self):
+        return self.to_dense().to_dataframe()
+
+    def to_dict(self):
+        heatmap = {}
+        for (i, j, count) in zip(self.rows.tolist(), self.cols.tolist(), self.counts.tolist()):
+            heatmap.setdefault(self.col_labels[j], {})[self.row_labels[i]] = count
+        return heatmap
+
+    def to_scipy(self):
+        """
+        Return the counts as a `scipy.sparse.coo_matrix` (requires scipy).
+        """
+        import scipy.sparse as _sparse
+        return _sparse.coo_matrix((self.counts, (self.rows, self.cols)), shape=self.shape)
+
+def count_pairs(rows, cols, n_rows, n_cols, weights=None):
+    """
+    Count the occurrences of each `(rows[k], cols[k])` pair (or sum their
+    `weights`) into a dense `(n_rows, n_cols)` matrix.
+    """
+    counts = _np.bincount(rows * n_cols + cols, weights=weights, minlength=n_rows * n_cols)
+    return counts.astype(_np.int64).reshape((n_rows, n_cols))
+
+def count_pairs_sparse(rows, cols, n_rows, n_cols, weights=None):
+    """
+    Count the occurrences of each `(rows[k], cols[k])` pair (or sum their
+    `weights`), returning the arrays `(rows, cols, counts)` of the non-zero
+    cells only.
+    """
+    if weights is None:
+        (keys, counts) = _np.unique(rows * n_cols + cols, return_counts=True)
+    else:
+        (keys, inverse) = _np.unique(rows * n_cols + cols, return_inverse=True)
+        counts = _np.bincount(inverse.ravel(), weights=weights, minlength=len(keys)).astype(_np.int64)
+        nonzero = counts != 0
+        (keys, counts) = (keys[nonzero], counts[nonzero])
+    return (keys // max(1, n_cols), keys % max(1, n_cols), counts)
+
+def _heatmap_from_pairs(rows, cols, row_labels, col_labels, weights=None, sparse=False):
+    # Count the (row, column) pairs into a heatmap, keeping only the keys
+    # that have comments (like `build_heatmap`), or non-zero (signed) counts
+    if sparse:
+        (rows, cols, counts) = count_pairs_sparse(
+            rows, cols, len(row_labels), len(col_labels), weights=weights)
+
+        (row_index, rows) = _np.unique(rows, return_inverse=True)
+        (col_index, cols) = _np.unique(cols, return_inverse=True)
+
+        return SparseHeatmapMatrix(
+            rows.ravel(), cols.ravel(), counts,
+            row_labels=[ row_labels[i] for i in row_index ],
+            col_labels=[ col_labels[j] for j in col_index ])
+
+    counts = count_pairs(rows, cols, len(row_labels), len(col_labels), weights=weights)
+
+    row_index = _np.flatnonzero(_np.abs(counts).sum(axis=1))
+    col_index = _np.flatnonzero(_np.abs(counts).sum(axis=0))
+
+    return HeatmapMatrix(
+        counts[row_index][:, col_index],
+        row_labels=[ row_labels[i] for i in row_index ],
+        col_labels=[ col_labels[j] for j in col_index ])
+
+def build_heatmap_matrix(hmapdata,
+                         x=HeatmapXAxis.GRADERS,
+                         y=HeatmapYAxis.COMMENTS,
+                         section_to_teacher=None,
+                         sparse=False):
+    """
+    Vectorized equivalent of `build_heatmap`, returning a `HeatmapMatrix`
+    (or a `SparseHeatmapMatrix`, with `sparse=True`). `hmapdata` may be a
+    `HeatmapData` (whose `CommentCube` is projected), a list of them (to
+    aggregate several assignments), `CommentCodes` or a `CommentCube`.
+    """
+    if isinstance(hmapdata, CommentCube):
+        return hmapdata.project(x=x, y=y, section_to_teacher=section_to_teacher, sparse=sparse)
+
+    if isinstance(hmapdata, CommentCodes):
+        codes = hmapdata
+    elif isinstance(hmapdata, (list, tuple)):
+        codes = CommentCodes.concatenate([ comment_codes(h) for h in hmapdata ])
+    else:
+        return comment_cube(hmapdata).project(
+            x=x, y=y, section_to_teacher=section_to_teacher, sparse=sparse)
+
+    (comment_index, x_code, x_labels) = codes.x_pairs(x, section_to_teacher)
+    (y_code, y_labels) = codes.y_codes(y)
+
+    return _heatmap_from_pairs(
+        y_code[comment_index], x_code, y_labels, x_labels, sparse=sparse)
+
+#########################################################################
+
+
+class HeatmapEstimate(object):
+    """
+    Heatmap estimated from a sample of the comments (see
+    `HeatmapData(..., sample=...)`): `estimate[i, j]` is the estimated
+    number of comments with the y-axis key `row_labels[i]` and the x-axis
+    key `col_labels[j]`, within `[lower[i, j], upper[i, j]]` at the given
+    `confidence`, and `sampled[i, j]` is the number of sampled comments.
+    """
+
+    def __init__(self, estimate, stderr, lower, upper, sampled, row_labels, col_labels,
+                 confidence, n_sampled, n_total):
+        self.estimate = estimate
+        self.stderr = stderr
+        self.lower = lower
+        self.upper = upper
+        self.sampled = sampled
+        self.row_labels = list(row_labels)
+        self.col_labels = list(col_labels)
+        self.confidence = confidence
+        self.n_sampled = n_sampled
+        self.n_total = n_total
+
+    @property
+    def shape(self):
+        return self.estimate.shape
+
+    @property
+    def fraction(self):
+        return float(self.n_sampled) / max(1, self.n_total)
+
+    def to_matrix(self):
+        """
+        Return the (rounded) estimated counts as a `HeatmapMatrix`, e.g. to
+        plot them with `render_heatmap_data`.
+        """
+        return HeatmapMatrix(
+            _np.rint(self.estimate).astype(_np.int64),
+            row_labels=self.row_labels, col_labels=self.col_labels)
+
+    def to_dataframe(self):
+        """
+        Return a long `pandas.DataFrame` with one row per cell (`row`, `col`,
+        `estimate`, `lower`, `upper`, `stderr` and `sampled`).
+        """
+        import pandas as _pd
+        (rows, cols) = _np.indices(self.shape)
+        return _pd.DataFrame({
+            "row": [ self.row_labels[i] for i in rows.ravel() ],
+            "col": [ self.col_labels[j] for j in cols.ravel() ],
+            "estimate": self.estimate.ravel(),
+            "lower": self.lower.ravel(),
+            "upper": self.upper.ravel(),
+            "stderr": self.stderr.ravel(),
+            "sampled": self.sampled.ravel(),
+        })
+
+def estimate_heatmap(hmapdata,
+                     x=HeatmapXAxis.GRADERS,
+                     y=HeatmapYAxis.COMMENTS,
+                     section_to_teacher=None,
+                     confidence=0.95):
+    """
+    Estimate the heatmap of a `HeatmapData` loaded from a stratified sample
+    of its comments (see `HeatmapData.stream_rubric`), returning a
+    `HeatmapEstimate`: the counts of each rubric comment (the strata) are
+    scaled by the inverse of its sampling fraction, with confidence
+    intervals. The counts of the rubric comments whose comments were all
+    loaded are exact (zero-width intervals).
+    """
+    codes = comment_codes(hmapdata)
+
+    # Strata: the comments linked to each rubric comment in the rubric
+    populations = {}
+    for (_, comment_obj) in hmapdata.iter_comments():
+        rubricComment_obj = comment_obj["rubricComment"]
+        populations[rubricComment_obj["id"]] = len(rubricComment_obj.get("comments", []))
+    n_strata = len(codes.rubric_comments)
+    population = _np.array(
+        [ populations[rubric_comment_id] for (_, rubric_comment_id) in codes.rubric_comments ],
+        dtype=_np.float64)
+    sampled = _np.bincount(codes.rubric_comment, minlength=n_strata).astype(_np.float64)
+    population = _np.maximum(population, sampled)
+
+    (comment_index, x_code, x_labels) = codes.x_pairs(x, section_to_teacher)
+    counts = count_pairs(
+        codes.rubric_comment[comment_index], x_code, n_strata, len(x_labels)).astype(_np.float64)
+
+    # Each comment is in a cell or not: estimated proportions, with the
+    # Agresti-Coull intervals of the sampled strata (centered on the
+    # adjusted proportion, so that the cells without sampled comments are
+    # not certain to be empty) and the finite population correction
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2.0)
+    n = sampled[:, None]
+    N = population[:, None]
+    complete = n >= N
+    p = counts / n
+    p_adjusted = _np.where(complete, p, (counts + z ** 2 / 2) / (n + z ** 2))
+    estimate = N * p
+    center = N * p_adjusted
+    variance = _np.where(
+        complete, 0.0,
+        (N ** 2) * (1 - n / N) * p_adjusted * (1 - p_adjusted) / (n + z ** 2))
+    # The comments which were not sampled are the only unknowns
+    bound = counts + (N - n)
+
+    if y == HeatmapYAxis.COMMENTS:
+        y_labels = codes.rubric_comments
+    elif y == HeatmapYAxis.CATEGORIES:
+        # The strata are nested in the categories: their estimates and
+        # variances add up (but not the adjustments, which would bias the
+        # intervals of the categories)
+        stratum_category = _np.zeros(n_strata, dtype=_np.int64)
+        stratum_category[codes.rubric_comment] = codes.category
+        y_labels = codes.categories
+        (estimate, variance, counts, bound) = [
+            _np.stack([ _np.bincount(stratum_category, weights=column, minlength=len(y_labels))
+                        for column in values.T ], axis=1)
+            if values.shape[1] > 0 else _np.zeros((len(y_labels), 0))
+            for values in (estimate, variance, counts, bound) ]
+        center = estimate
+    else:
+        raise ValueError("Unknown y-axis: {}".format(y))
+
+    # Keep only the keys that have comments (like `build_heatmap`)
+    row_index = _np.flatnonzero(counts.sum(axis=1))
+    col_index = _np.flatnonzero(counts.sum(axis=0))
+    (estimate, center, variance, counts, bound) = [
+        values[row_index][:, col_index]
+        for values in (estimate, center, variance, counts, bound) ]
+
+    stderr = _np.sqrt(_np.maximum(variance, 0.0))
+    return HeatmapEstimate(
+        estimate=estimate,
+        stderr=stderr,
+        # At least the comments that were sampled, at most all the others
+        lower=_np.minimum(_np.maximum(center - z * stderr, counts), estimate),
+        upper=_np.maximum(_np.minimum(center + z * stderr, bound), estimate),
+        sampled=counts.astype(_np.int64),
+        row_labels=[ y_labels[i] for i in row_index ],
+        col_labels=[ x_labels[j] for j in col_index ],
+        confidence=confidence,
+        n_sampled=len(codes),
+        n_total=int(population.sum()))
@@ -0,0 +1,287 @@
+
+# Python dependencies
+#
+from __future__ import print_function # Python 2
+
+# External dependencies
+#
+import numpy as _np
+
+# Local dependencies
+#
+from . import util as _util
+from . import aggregate as _aggregate
+
+#########################################################################
+
+
+_logger = _util.getLogger()
+
+DEFAULT_OUTLIER_THRESHOLD = 3.0  # Absolute z-score
+
+#########################################################################
+
+
+class HeatmapStack(object):
+    """
+    Heatmaps of several layers (typically one per assignment) on shared
+    labels, stored as one block of rows per layer: `counts[r]` holds the
+    counts of the row `row_labels[row_index[r]]` of the layer
+    `layer_labels[row_layer[r]]`, for the rows of each layer which have
+    comments only. The memory thus grows with the rows of each layer,
+    rather than with the union of the labels of all the layers.
+    """
+
+    def __init__(self, counts, row_layer, row_index, row_labels, col_labels, layer_labels):
+        self.counts = counts
+        self.row_layer = row_layer
+        self.row_index = row_index
+        self.row_labels = list(row_labels)
+        self.col_labels = list(col_labels)
+        self.layer_labels = list(layer_labels)
+
+    def __len__(self):
+        return len(self.layer_labels)
+
+    def layer(self, k):
+        """
+        Return the heatmap of the layer `k` as a `HeatmapMatrix`.
+        """
+        block = _np.flatnonzero(self.row_layer == k)
+        return _aggregate.HeatmapMatrix(
+            self.counts[block],
+            row_labels=[ self.row_labels[i] for i in self.row_index[block] ],
+            col_labels=self.col_labels)
+
+    @classmethod
+    def from_keys(cls, layer, rows, cols, row_labels, col_labels, layer_labels, weights=None):
+        """
+        Count the `(layer[k], rows[k], cols[k])` triples (codes of the
+        labels), or sum their `weights`, into a stack, keeping only the
+        labels with comments.
+        """
+        (n_rows, n_cols) = (max(1, len(row_labels)), len(col_labels))
+        (block_keys, block_rows) = _np.unique(layer * n_rows + rows, return_inverse=True)
+        (col_index, cols) = _np.unique(cols, return_inverse=True)
+        counts = _aggregate.count_pairs(
+            block_rows.ravel(), cols.ravel(), len(block_keys), len(col_index), weights=weights)
+
+        (row_index, row_codes) = _np.unique(block_keys % n_rows, return_inverse=True)
+        return cls(
+            counts,
+            row_layer=block_keys // n_rows,
+            row_index=row_codes.ravel(),
+            row_labels=[ row_labels[i] for i in row_index ],
+            col_labels=[ col_labels[j] for j in col_index ],
+            layer_labels=layer_labels)
+
+def stack_matrices(matrices, layer_labels=None):
+    """
+    Align heatmaps (`HeatmapMatrix` or `SparseHeatmapMatrix`, typically one
+    per assignment) on the union of their labels, as a `HeatmapStack` whose
+    layer `k` holds the counts of `matrices[k]`.
+    """
+    row_labels, row_codes = [], {}
+    col_labels, col_codes = [], {}
+    cells = []
+    for (k, matrix) in enumerate(matrices):
+        if isinstance(matrix, _aggregate.HeatmapMatrix):
+            matrix = matrix.to_sparse()
+        rows = _aggregate._remap(row_labels, matrix.row_labels, row_codes)
+        cols = _aggregate._remap(col_labels, matrix.col_labels, col_codes)
+        cells.append(_np.stack([
+            _np.full(len(matrix.rows), k, dtype=_np.int64),
+            rows[matrix.rows], cols[matrix.cols], matrix.counts ]))
+
+    (layer, rows, cols, counts) = (
+        _np.concatenate(cells, axis=1) if len(cells) > 0 else _np.zeros((4, 0), dtype=_np.int64))
+    if layer_labels == None:
+        layer_labels = list(range(len(cells)))
+    return HeatmapStack.from_keys(
+        layer, rows, cols, row_labels, col_labels, layer_labels, weights=counts)
+
+class HeatmapAnalysis(object):
+    """
+    Grader-consistency statistics of a heatmap count matrix (rows are rubric
+    comments or categories, columns are graders, sections or teachers), or
+    of a `HeatmapStack` of them (one per assignment), computed for all the
+    cells (and assignments) at once:
+
+    - `rates`: usage rate of each row by each column, normalized by the
+      number of comments of the column;
+    - `expected`: the course-wide distribution of the rows (per assignment);
+    - `z_scores`: deviation of each rate from the course-wide one, in
+      standard errors (binomial), 0 where undefined;
+    - `chi2_contributions`: `(observed - expected)^2 / expected` of each
+      cell, and `chi2`, their sum per column (how much a grader's usage of
+      the rubric deviates overall).
+
+    The statistics of the cells of a stack are arrays with one row per row
+    of its blocks (see `HeatmapStack`); `col_totals`, `chi2`, `totals` and
+    `dof` have one entry per layer.
+    """
+
+    # Statistics with one entry per layer, rather than per row
+    _PER_LAYER = ["col_totals", "totals", "chi2", "dof"]
+
+    def __init__(self, counts, row_labels, col_labels, layer_labels=None,
+                 row_layer=None, row_index=None):
+        counts = _np.asarray(counts, dtype=_np.int64)
+        self._stacked = row_layer is not None
+        if not self._stacked:
+            row_layer = _np.zeros(len(counts), dtype=_np.int64)
+            row_index = _np.arange(len(counts), dtype=_np.int64)
+            layer_labels = [0]
+
+        self.counts = counts
+        self.row_layer = row_layer
+        self.row_index = row_index
+        self.row_labels = list(row_labels)
+        self.col_labels = list(col_labels)
+        self.layer_labels = list(layer_labels)
+        n_layers = len(self.layer_labels)
+
+        # Totals per column (comment volume), per row and per layer
+        self.col_totals = self._per_layer(counts)
+        self.row_totals = counts.sum(axis=1)
+        self.totals = _np.bincount(
+            row_layer, weights=self.row_totals, minlength=n_layers).astype(_np.int64)
+
+        n = self.col_totals[row_layer].astype(_np.float64)
+        with _np.errstate(divide="ignore", invalid="ignore"):
+            self.rates = _np.where(n > 0, counts / n, 0.0)
+            total = self.totals[row_layer].astype(_np.float64)
+            self.expected = _np.where(total > 0, self.row_totals / total, 0.0)
+
+            p = self.expected[:, _np.newaxis]
+            stderr = _np.sqrt(p * (1.0 - p) / n)
+            self.z_scores = _np.where(
+                (n > 0) & (stderr > 0), (self.rates - p) / stderr, 0.0)
+
+            expected_counts = p * n
+            self.chi2_contributions = _np.where(
+                expected_counts > 0, (counts - expected_counts) ** 2 / expected_counts, 0.0)
+
+        self.chi2 = self._per_layer(self.chi2_contributions)
+        # Degrees of freedom of the goodness-of-fit test of each column
+        self.dof = _np.maximum(0, _np.bincount(
+            row_layer, weights=self.row_totals > 0, minlength=n_layers).astype(_np.int64) - 1)
+
+    def _per_layer(self, values):
+        # Sum of the rows of each block
+        totals = _np.zeros((len(self.layer_labels), values.shape[1]), dtype=values.dtype)
+        _np.add.at(totals, self.row_layer, values)
+        return totals
+
+    @classmethod
+    def from_matrix(cls, matrix):
+        """
+        Analyze a `HeatmapMatrix` or `SparseHeatmapMatrix`.
+        """
+        if isinstance(matrix, _aggregate.SparseHeatmapMatrix):
+            matrix = matrix.to_dense()
+        return cls(matrix.counts, matrix.row_labels, matrix.col_labels)
+
+    @classmethod
+    def from_stack(cls, stack):
+        """
+        Analyze a `HeatmapStack` (see `stack_matrices` and `Archive.stack`).
+        """
+        return cls(stack.counts, stack.row_labels, stack.col_labels,
+                   layer_labels=stack.layer_labels,
+                   row_layer=stack.row_layer, row_index=stack.row_index)
+
+    @classmethod
+    def from_matrices(cls, matrices, layer_labels=None):
+        """
+        Analyze several heatmaps (e.g. one per assignment, see
+        `stack_matrices`) at once.
+        """
+        return cls.from_stack(stack_matrices(matrices, layer_labels=layer_labels))
+
+    def get(self, name):
+        """
+        Return the statistic `name` ("counts", "rates", "z_scores",
+        "chi2_contributions", ...) with the shape of the analyzed counts.
+        """
+        values = getattr(self, name)
+        if name in self._PER_LAYER and not self._stacked:
+            return values[0]
+        return values
+
+    def outliers(self, threshold=DEFAULT_OUTLIER_THRESHOLD, n=None):
+        """
+        Return the cells whose absolute z-score is at least `threshold`, by
+        decreasing absolute z-score (at most `n` of them), as dicts with the
+        row and column labels, the count, rate, course-wide rate, z-score
+        and chi-square contribution (and the layer label, for stacks).
+        """
+        scores = _np.abs(self.z_scores)
+        (rows, cols) = _np.nonzero(scores >= threshold)
+        order = _np.argsort(-scores[rows, cols], kind="stable")
+        if n != None:
+            order = order[:n]
+
+        outliers = []
+        for (r, j) in zip(rows[order].tolist(), cols[order].tolist()):
+            outlier = {
+                "row": self.row_labels[self.row_index[r]],
+                "col": self.col_labels[j],
+                "count": int(self.counts[r, j]),
+                "rate": float(self.rates[r, j]),
+                "expected": float(self.expected[r]),
+                "z_score": float(self.z_scores[r, j]),
+                "chi2": float(self.chi2_contributions[r, j]),
+            }
+            if self._stacked:
+                outlier["layer"] = self.layer_labels[self.row_layer[r]]
+            outliers.append(outlier)
+        return outliers
+
+    def ranking(self, n=None):
+        """
+        Return the columns (typically graders) by decreasing chi-square
+        deviation from the course-wide distribution, as dicts with the
+        column label, comment volume, chi-square and degrees of freedom (and
+        the layer label, for stacks). Columns without comments are skipped.
+        """
+        (layers, cols) = _np.nonzero(self.col_totals > 0)
+        order = _np.argsort(-self.chi2[layers, cols], kind="stable")
+        if n != None:
+            order = order[:n]
+
+        ranking = []
+        for (k, j) in zip(layers[order].tolist(), cols[order].tolist()):
+            entry = {
+                "col": self.col_labels[j],
+                "comments": int(self.col_totals[k, j]),
+                "chi2": float(self.chi2[k, j]),
+                "dof": int(self.dof[k]),
+            }
+            if self._stacked:
+                entry["layer"] = self.layer_labels[k]
+            ranking.append(entry)
+        return ranking
+
+    def to_dataframe(self, name="z_scores", layer=0):
+        """
+        Return a statistic with one value per cell ("rates", "z_scores",
+        "chi2_contributions", ...) of one layer as a dataframe.
+        """
+        import pandas as _pd
+        block = _np.flatnonzero(self.row_layer == layer)
+        return _pd.DataFrame(
+            getattr(self, name)[block],
+            index=_pd.Index([ self.row_labels[i] for i in self.row_index[block] ]),
+            columns=_pd.Index(self.col_labels))
+
+def analyze(data, layer_labels=None):
+    """
+    Return the `HeatmapAnalysis` of a heatmap matrix, of a `HeatmapStack`,
+    or of a list of matrices (aligned on the union of their labels).
+    """
+    if isinstance(data, HeatmapStack):
+        return HeatmapAnalysis.from_stack(data)
+    if isinstance(data, (list, tuple)):
+        return HeatmapAnalysis.from_matrices(data, layer_labels=layer_labels)
+    return HeatmapAnalysis.from_matrix(data)
@@ -0,0 +1,409 @@
+
+# Python dependencies
+#
+from __future__ import print_function # Python 2
+#
+import glob as glob
+import json as json
+import os as os
+import re as re
+import shutil as shutil
+
+# External dependencies
+#
+import numpy as _np
+
+# Local dependencies
+#
+from . import util as _util
+from . import cache as _cache
+from . import aggregate as _aggregate
+from .aggregate import HeatmapXAxis as HeatmapXAxis
+from .aggregate import HeatmapYAxis as HeatmapYAxis
+
+#########################################################################
+
+
+_logger = _util.getLogger()
+
+ARCHIVE_FORMAT_VERSION = 1
+
+# One row per comment
+COMMENT_COLUMNS = ["comment_id", "assignment", "grader", "rubric_comment", "category"]
+
+# One row per (comment, section) pair, since a comment may be linked to
+# several sections; `section_comment` is the row of the comment
+SECTION_COLUMNS = ["section_comment", "section"]
+
+_DICTIONARIES = ["graders", "rubric_comments", "categories", "sections"]
+
+# Number of rows copied at once when writing the columns
+_CHUNK_ROWS = 1 << 20
+
+_CACHE_FILENAME_PATTERN = re.compile(r"codePost_heatmap_cache_assignment_(\d+)\.json$")
+
+#########################################################################
+
+
+def _column_filename(directory, name):
+    return os.path.join(directory, name + ".npy")
+
+def _meta_filename(directory):
+    return os.path.join(directory, "meta.json")
+
+class ArchiveWriter(object):
+    """
+    Compacts the comments of many assignments into an archive (see
+    `Archive`), one assignment at a time: only the integer-coded columns of
+    the assignment being added are ever in memory.
+
+    The columns are appended to temporary files, and only written as NumPy
+    arrays (and the archive replaced) by `close`. An existing archive is
+    extended; assignments that are already in it are replaced.
+
+    Usable as a context manager.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._tmp_directory = directory.rstrip(os.sep) + ".tmp"
+
+        if os.path.exists(self._tmp_directory):
+            shutil.rmtree(self._tmp_directory)
+        os.makedirs(self._tmp_directory)
+
+        self._labels = dict((name, []) for name in _DICTIONARIES)
+        self._label_codes = dict((name, {}) for name in _DICTIONARIES)
+        self._assignments = []
+        self._n_comments = 0
+        self._n_sections = 0
+        self._files = dict(
+            (name, open(os.path.join(self._tmp_directory, name + ".bin"), "wb"))
+            for name in COMMENT_COLUMNS + SECTION_COLUMNS)
+
+        if os.path.exists(_meta_filename(directory)):
+            self._pending = Archive(directory)
+        else:
+            self._pending = None
+
+    def add(self, assignment_id, source):
+        """
+        Add the comments of an assignment, from a `HeatmapData`, the
+        filename of its cache, a map of comment IDs to enriched comments, or
+        `CommentCodes`.
+        """
+        if isinstance(source, _aggregate.CommentCodes):
+            codes = source
+        elif isinstance(source, str):
+            codes = _aggregate.CommentCodes.from_comments(_cache.load(source).items())
+        elif isinstance(source, dict):
+            codes = _aggregate.CommentCodes.from_comments(source.items())
+        else:
+            codes = _aggregate.comment_codes(source)
+
+        self._append(assignment_id, codes)
+
+    def add_caches(self, pattern="codePost_heatmap_cache_assignment_*.json"):
+        """
+        Add the assignments of all the cache files matching `pattern` (the
+        assignment IDs are read from the filenames).
+        """
+        for filename in sorted(glob.glob(pattern)):
+            match = _CACHE_FILENAME_PATTERN.search(filename)
+            if match == None:
+                continue
+            _logger.debug("Archiving {}".format(filename))
+            self.add(int(match.group(1)), filename)
+
+    def _append(self, assignment_id, codes):
+        if any(a["id"] == assignment_id for a in self._assignments):
+            raise ValueError("Assignment {} was already added.".format(assignment_id))
+
+        remap = dict(
+            (name, _aggregate._remap(self._labels[name], getattr(codes, name), self._label_codes[name]))
+            for name in _DICTIONARIES)
+
+        columns = {
+            "comment_id": codes.comment_ids,
+            "assignment": _np.full(len(codes), len(self._assignments), dtype=_np.int64),
+            "grader": remap["graders"][codes.grader],
+            "rubric_comment": remap["rubric_comments"][codes.rubric_comment],
+            "category": remap["categories"][codes.category],
+            "section_comment": codes.section_comment + self._n_comments,
+            "section": remap["sections"][codes.section],
+        }
+        for (name, values) in columns.items():
+            self._files[name].write(_np.ascontiguousarray(values, dtype=_np.int64).tobytes())
+
+        self._assignments.append({
+            "id": assignment_id,
+            "comments": [self._n_comments, self._n_comments + len(codes)],
+            "sections": [self._n_sections, self._n_sections + len(codes.section)],
+        })
+        self._n_comments += len(codes)
+        self._n_sections += len(codes.section)
+
+    def _append_pending(self):
+        # Copy the assignments of the archive being extended (unless they
+        # were added again), one at a time
+        archive = self._pending
+        self._pending = None
+        added = set(a["id"] for a in self._assignments)
+        for assignment_id in archive.assignment_ids:
+            if assignment_id not in added:
+                self._append(assignment_id, archive.codes([assignment_id]))
+
+    def close(self):
+        if self._pending != None:
+            self._append_pending()
+
+        for f in self._files.values():
+            f.close()
+
+        # Convert the raw columns into NumPy arrays, by chunks
+        for name in COMMENT_COLUMNS + SECTION_COLUMNS:
+            raw_filename = os.path.join(self._tmp_directory, name + ".bin")
+            n_rows = os.path.getsize(raw_filename) // 8
+            column = _np.lib.format.open_memmap(
+                _column_filename(self._tmp_directory, name),
+                mode="w+", dtype=_np.int64, shape=(n_rows,))
+            if n_rows > 0:
+                raw = _np.memmap(raw_filename, dtype=_np.int64, mode="r", shape=(n_rows,))
+                for start in range(0, n_rows, _CHUNK_ROWS):
+                    column[start:start + _CHUNK_ROWS] = raw[start:start + _CHUNK_ROWS]
+                del raw
+            column.flush()
+            del column
+            os.remove(raw_filename)
+
+        meta = {
+            "version": ARCHIVE_FORMAT_VERSION,
+            "assignments": self._assignments,
+            "graders": self._labels["graders"],
+            "rubricComments": [ list(label) for label in self._labels["rubric_comments"] ],
+            "categories": self._labels["categories"],
+            "sections": self._labels["sections"],
+        }
+        with open(_meta_filename(self._tmp_directory), "w") as f:
+            json.dump(meta, f, separators=(",", ":"))
+
+        # Replace the archive (the old one may still be memory-mapped
+        # elsewhere, which is fine on POSIX systems)
+        if os.path.exists(self._directory):
+            shutil.rmtree(self._directory)
+        os.rename(self._tmp_directory, self._directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type == None:
+            self.close()
+            return
+        for f in self._files.values():
+            f.close()
+        shutil.rmtree(self._tmp_directory, ignore_errors=True)
+
+def build_archive(directory, sources):
+    """
+    Write the archive `directory` from a map of assignment IDs to sources
+    (see `ArchiveWriter.add`), such as a `HeatmapCollection`, or from an
+    iterable of `HeatmapData`.
+    """
+    if hasattr(sources, "items"):
+        items = sources.items()
+    else:
+        items = [ (hmapdata._assignment_id, hmapdata) for hmapdata in sources ]
+
+    with ArchiveWriter(directory) as writer:
+        for (assignment_id, source) in items:
+            writer.add(assignment_id, source)
+
+#########################################################################
+
+
+class Archive(object):
+    """
+    Columnar archive of the comments of many assignments (written by
+    `ArchiveWriter`): a directory of integer columns (`COMMENT_COLUMNS` and
+    `SECTION_COLUMNS`, as `.npy` files) and of `meta.json`, which holds the
+    dictionaries of the codes (graders, rubric comments as `(text, id)`
+    pairs, categories and sections) and the rows of each assignment.
+
+    The columns are memory-mapped, and only read when a query needs them:
+    queries only touch the rows of the selected assignments, and never
+    build the per-comment dicts.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        with open(_meta_filename(directory)) as f:
+            meta = json.load(f)
+
+        if meta.get("version") != ARCHIVE_FORMAT_VERSION:
+            raise ValueError("Unsupported archive format version: {}".format(meta.get("version")))
+
+        self._assignments = meta["assignments"]
+        self._assignment_index = dict(
+            (a["id"], index) for (index, a) in enumerate(self._assignments))
+        self.graders = meta["graders"]
+        self.rubric_comments = [ tuple(label) for label in meta["rubricComments"] ]
+        self.categories = meta["categories"]
+        self.sections = meta["sections"]
+        self._columns = {}
+
+    @property
+    def assignment_ids(self):
+        return [ a["id"] for a in self._assignments ]
+
+    def __len__(self):
+        # Number of comments
+        return self._assignments[-1]["comments"][1] if len(self._assignments) > 0 else 0
+
+    def __contains__(self, assignment_id):
+        return assignment_id in self._assignment_index
+
+    def column(self, name):
+        """
+        Return the (memory-mapped, read-only) column `name`.
+        """
+        column = self._columns.get(name)
+        if column is None:
+            column = _np.load(_column_filename(self._directory, name), mmap_mode="r")
+            self._columns[name] = column
+        return column
+
+    def _ranges(self, assignment_ids, key):
+        if assignment_ids == None:
+            return [ a[key] for a in self._assignments ]
+        try:
+            return [ self._assignments[self._assignment_index[a]][key] for a in assignment_ids ]
+        except KeyError as exc:
+            raise KeyError("Assignment not in the archive: {}".format(exc.args[0]))
+
+    def _read(self, name, ranges):
+        # Rows of the column in the given ranges (contiguous when there is a
+        # single range, so that nothing but the range is read)
+        column = self.column(name)
+        if len(ranges) == 1:
+            (start, end) = ranges[0]
+            return _np.asarray(column[start:end])
+        if len(ranges) == 0:
+            return _np.zeros(0, dtype=_np.int64)
+        return _np.concatenate([ column[start:end] for (start, end) in ranges ])
+
+    def _section_pairs(self, assignment_ids):
+        # The (comment, section) pairs of the selected assignments, with the
+        # comments numbered from 0 in the order of the selected rows
+        comment_ranges = self._ranges(assignment_ids, "comments")
+        section_ranges = self._ranges(assignment_ids, "sections")
+
+        section_comment = self._read("section_comment", section_ranges)
+        offsets = []
+        position = 0
+        for ((c_start, c_end), (s_start, s_end)) in zip(comment_ranges, section_ranges):
+            offsets.append(_np.full(s_end - s_start, position - c_start, dtype=_np.int64))
+            position += c_end - c_start
+        if len(offsets) > 0:
+            section_comment = section_comment + _np.concatenate(offsets)
+
+        return (section_comment, self._read("section", section_ranges))
+
+    def codes(self, assignment_ids=None):
+        """
+        Return the `CommentCodes` of the selected assignments (all of them by
+        default), with the dictionaries of the whole archive as labels.
+        """
+        ranges = self._ranges(assignment_ids, "comments")
+        (section_comment, section) = self._section_pairs(assignment_ids)
+        return _aggregate.CommentCodes(
+            comment_ids=self._read("comment_id", ranges),
+            grader=self._read("grader", ranges),
+            rubric_comment=self._read("rubric_comment", ranges),
+            category=self._read("category", ranges),
+            section_comment=section_comment,
+            section=section,
+            graders=self.graders,
+            rubric_comments=self.rubric_comments,
+            categories=self.categories,
+            sections=self.sections)
+
+    def cube(self, assignment_ids=None):
+        """
+        Return the `CommentCube` of the selected assignments.
+        """
+        return _aggregate.CommentCube.from_codes(self.codes(assignment_ids))
+
+    def _axes(self, x, y, assignment_ids, section_to_teacher):
+        # The (comment, x-axis key) pairs and the y-axis key of each comment
+        # of the selected assignments, reading only the columns of the axes
+        ranges = self._ranges(assignment_ids, "comments")
+
+        if y == HeatmapYAxis.COMMENTS:
+            (y_code, y_labels) = (self._read("rubric_comment", ranges), self.rubric_comments)
+        elif y == HeatmapYAxis.CATEGORIES:
+            (y_code, y_labels) = (self._read("category", ranges), self.categories)
+        else:
+            raise ValueError("Unknown y-axis: {}".format(y))
+
+        if x == HeatmapXAxis.GRADERS:
+            (comment_index, x_code, x_labels) = (
+                _np.arange(len(y_code), dtype=_np.int64),
+                self._read("grader", ranges),
+                self.graders)
+        elif x == HeatmapXAxis.SECTIONS:
+            (comment_index, x_code) = self._section_pairs(assignment_ids)
+            x_labels = self.sections
+        elif x == HeatmapXAxis.TEACHERS:
+            if section_to_teacher == None:
+                raise ValueError(
+                    "'section_to_teacher' needs to be defined for TEACHERS")
+            (section_comment, section) = self._section_pairs(assignment_ids)
+            (comment_index, x_code, x_labels) = _aggregate.teacher_pairs(
+                section_comment, section, self.sections, section_to_teacher)
+        else:
+            raise ValueError("Unknown x-axis: {}".format(x))
+
+        return (comment_index, x_code, x_labels, y_code, y_labels)
+
+    def query(self,
+              x=HeatmapXAxis.GRADERS,
+              y=HeatmapYAxis.COMMENTS,
+              assignment_ids=None,
+              section_to_teacher=None,
+              sparse=False):
+        """
+        Return the heatmap of the selected assignments (all of them by
+        default), like `build_heatmap_matrix`, reading only the columns of
+        the axes.
+        """
+        (comment_index, x_code, x_labels, y_code, y_labels) = self._axes(
+            x, y, assignment_ids, section_to_teacher)
+
+        return _aggregate._heatmap_from_pairs(
+            y_code[comment_index], x_code, y_labels, x_labels, sparse=sparse)
+
+    def stack(self,
+              x=HeatmapXAxis.GRADERS,
+              y=HeatmapYAxis.COMMENTS,
+              assignment_ids=None,
+              section_to_teacher=None):
+        """
+        Return the heatmaps of the selected assignments at once, as an
+        `analytics.HeatmapStack` whose layers are the assignments (see
+        `analytics.HeatmapAnalysis.from_stack`).
+        """
+        from . import analytics as _analytics
+
+        if assignment_ids == None:
+            assignment_ids = self.assignment_ids
+        (comment_index, x_code, x_labels, y_code, y_labels) = self._axes(
+            x, y, assignment_ids, section_to_teacher)
+
+        # Layer of each selected comment (in the order of `assignment_ids`)
+        sizes = [ end - start for (start, end) in self._ranges(assignment_ids, "comments") ]
+        layer = _np.repeat(_np.arange(len(sizes), dtype=_np.int64), sizes)
+
+        return _analytics.HeatmapStack.from_keys(
+            layer[comment_index], y_code[comment_index], x_code,
+            y_labels, x_labels, list(assignment_ids))
@@ -0,0 +1,214 @@
+
+# Python dependencies
+#
+from __future__ import print_function # Python 2
+#
+import json as json
+import os as os
+import threading as threading
+
+# Local dependencies
+#
+from . import util as _util
+
+#########################################################################
+
+
+_logger = _util.getLogger()
+
+# Version 1: the map of comment IDs to enriched comments, as is (implicit).
+# Version 2: normalized rubric comments, categories and sections, and
+#            comments as compact rows referencing them; optionally, the
+#            count cube of the comments ("cube").
+CACHE_FORMAT_VERSION = 2
+
+# Fields of the enriched comments which are normalized (see `encode_comments`)
+_NORMALIZED_FIELDS = ["id", "rubricComment", "category", "sections"]
+
+#########################################################################
+
+
+def encode_comments(comments):
+    """
+    Convert a map of comment IDs to enriched comments (as produced by
+    `HeatmapData.process_rubric`) into a normalized, JSON-serializable
+    object: the rubric comments, categories and sections are stored once,
+    and each comment becomes a row referencing them by ID or index.
+    """
+    rubricComments = {}
+    categories = {}
+    sections = {}
+    fields = set()
+
+    for comment_obj in comments.values():
+        rubricComment_obj = comment_obj["rubricComment"]
+        rubricComments.setdefault(rubricComment_obj["id"], rubricComment_obj)
+        categories.setdefault(comment_obj["category"], len(categories))
+        for section in comment_obj["sections"]:
+            sections.setdefault(section, len(sections))
+        fields.update(comment_obj.keys())
+
+    fields = _NORMALIZED_FIELDS + sorted(fields - set(_NORMALIZED_FIELDS))
+
+    rows = []
+    for (comment_id, comment_obj) in comments.items():
+        row = [
+            int(comment_id),
+            comment_obj["rubricComment"]["id"],
+            categories[comment_obj["category"]],
+            [ sections[section] for section in comment_obj["sections"] ],
+        ]
+        row += [ comment_obj.get(field) for field in fields[len(_NORMALIZED_FIELDS):] ]
+        rows.append(row)
+
+    return {
+        "version": CACHE_FORMAT_VERSION,
+        "rubricComments": list(rubricComments.values()),
+        "categories": sorted(categories, key=categories.get),
+        "sections": sorted(sections, key=sections.get),
+        "fields": fields,
+        "comments": rows,
+    }
+
+def decode_comments(obj):
+    """
+    Convert an object produced by `encode_comments` (or a legacy, version 1
+    cache) back into a map of (integer) comment IDs to enriched comments.
+    The rubric comment objects are shared by all the comments referencing
+    them.
+    """
+    if not isinstance(obj, dict):
+        raise ValueError("Invalid cache: expected an object.")
+
+    # Version 1: comment IDs were serialized as strings
+    if "version" not in obj:
+        return dict(
+            (int(comment_id), comment_obj)
+            for (comment_id, comment_obj) in obj.items())
+
+    if obj["version"] != CACHE_FORMAT_VERSION:
+        raise ValueError("Unsupported cache format version: {}".format(obj["version"]))
+
+    rubricComments = dict(
+        (rubricComment_obj["id"], rubricComment_obj)
+        for rubricComment_obj in obj["rubricComments"])
+    categories = obj["categories"]
+    sections = obj["sections"]
+    fields = obj["fields"][len(_NORMALIZED_FIELDS):]
+
+    comments = {}
+    for row in obj["comments"]:
+        comment_obj = dict(zip(fields, row[len(_NORMALIZED_FIELDS):]))
+        comment_obj["id"] = row[0]
+        comment_obj["rubricComment"] = rubricComments[row[1]]
+        comment_obj["category"] = categories[row[2]]
+        comment_obj["sections"] = [ sections[index] for index in row[3] ]
+        comments[row[0]] = comment_obj
+
+    return comments
+
+#########################################################################
+
+
+def load(filename):
+    return load_with_cube(filename)[0]
+
+def load_with_cube(filename):
+    """
+    Return the comments of a cache, and the state of their count cube (see
+    `aggregate.CommentCube`) if it was stored with them, or else `None`.
+    """
+    with open(filename) as f:
+        obj = json.load(f)
+    comments = decode_comments(obj)
+
+    cube = obj.get("cube") if "version" in obj else None
+    # A cube which does not account for all the comments is stale
+    if cube != None and sum(cube["cells"][3]) != len(comments):
+        cube = None
+
+    return (comments, cube)
+
+def store(filename, comments, cube=None):
+    """
+    Store the comments (and the state of their count cube, if given) into
+    the cache `filename`.
+    """
+    obj = encode_comments(comments)
+    if cube != None:
+        obj["cube"] = cube
+
+    # Write to a temporary file first, so that an interrupted write never
+    # leaves a truncated cache behind
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        # Compact separators: indentation more than doubles the size of the file
+        json.dump(obj, f, separators=(",", ":"))
+    os.replace(tmp_filename, filename)
+
+#########################################################################
+
+
+class Journal(object):
+    """
+    Append-only journal (one JSON object per line) of the enriched comments
+    of an initialization in progress, so that an interrupted initialization
+    can be resumed without fetching these comments again.
+
+    The rubric comment is recorded by ID, and the category and sections are
+    not recorded: they are derived again from the current rubric and
+    sections when resuming.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._file = None
+
+    @property
+    def filename(self):
+        return self._filename
+
+    def load(self):
+        """
+        Return the map of comment IDs to the (partial) comments recorded so
+        far; a line truncated by a crash is ignored.
+        """
+        comments = {}
+        if not os.path.exists(self._filename):
+            return comments
+
+        with open(self._filename) as f:
+            for line in f:
+                try:
+                    comment_obj = json.loads(line)
+                except ValueError:
+                    continue
+                comments[comment_obj["id"]] = comment_obj
+
+        return comments
+
+    def append(self, comment_id, comment_obj):
+        entry = dict(
+            (key, value) for (key, value) in comment_obj.items()
+            if key not in ("rubricComment", "category", "sections"))
+        entry["id"] = comment_id
+        entry["rubricComment"] = comment_obj["rubricComment"]["id"]
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+
+        with self._lock:
+            if self._file == None:
+                self._file = open(self._filename, "a")
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file != None:
+                self._file.close()
+                self._file = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self._filename):
+            os.remove(self._filename)
@@ -0,0 +1,265 @@
+"""
+Command-line interface:
+
+    python -m heatmap render ASSIGNMENT_ID [...] [--axes graders:rubricComments ...]
+    python -m heatmap watch ASSIGNMENT_ID [...] [--interval SECONDS]
+    python -m heatmap serve [ASSIGNMENT_ID ...] [--port PORT]
+
+`render` exports the heatmaps of the assignments once. `watch` keeps them
+up to date: it polls the rubric of each assignment with conditional
+requests, and only when it changed, refreshes the comments and re-renders
+the heatmaps whose counts changed. `serve` runs a `server.HeatmapService`.
+"""
+
+# Python dependencies
+#
+from __future__ import print_function # Python 2
+#
+import argparse as argparse
+import json as json
+import os as os
+import sys as sys
+import time as time
+
+# Local dependencies
+#
+from . import util as _util
+from .preprocess import HeatmapData as HeatmapData
+
+#########################################################################
+
+
+_logger = _util.getLogger()
+
+DEFAULT_AXES = ["graders:rubricComments"]
+DEFAULT_INTERVAL = 60.0            # Seconds between two polls of the rubric
+DEFAULT_SECTIONS_INTERVAL = 3600.0 # Seconds between two updates of the sections
+
+#########################################################################
+
+
+def parse_axes(value):
+    """
+    Parse an "x:y" pair of axis values (e.g. "sections:rubricCategories").
+    """
+    # The axes are defined with the (numpy-dependent) aggregation
+    from .aggregate import HeatmapXAxis, HeatmapYAxis, axis_from_value
+
+    (x, _, y) = value.partition(":")
+    try:
+        return (axis_from_value(HeatmapXAxis, x), axis_from_value(HeatmapYAxis, y))
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError("invalid axes '{}': {}".format(value, exc))
+
+def load_section_to_teacher(filename):
+    if filename == None:
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+def _data_arguments(parser, nargs="+"):
+    parser.add_argument("assignment_ids", metavar="ASSIGNMENT_ID", type=int, nargs=nargs)
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help="do not read or write the comments cache")
+    parser.add_argument("--max-workers", type=int, default=8)
+    parser.add_argument("--prefetch", action="store_true",
+                        help="download all the submissions in one request")
+
+def _render_arguments(parser):
+    parser.add_argument("--axes", action="append", type=str, default=None,
+                        help="'x:y' axes of a heatmap (repeatable, default: {})".format(
+                            DEFAULT_AXES[0]))
+    parser.add_argument("--section-to-teacher", metavar="FILENAME",
+                        help="JSON map of section names to teachers (for sectionsLeaders)")
+    parser.add_argument("--directory", default=".",
+                        help="directory of the images")
+    parser.add_argument("--format", default="png", choices=["png", "svg", "pdf"])
+    parser.add_argument("--max-rows", type=int, default=None)
+    parser.add_argument("--rows-per-page", type=int, default=None)
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m heatmap",
+        description="Heatmaps of the rubric comments of codePost assignments.")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    render = commands.add_parser("render", help="export the heatmaps once")
+    _data_arguments(render)
+    _render_arguments(render)
+
+    watch = commands.add_parser(
+        "watch", help="keep the heatmaps up to date while grading is ongoing")
+    _data_arguments(watch)
+    _render_arguments(watch)
+    watch.add_argument("--interval", type=float, default=DEFAULT_INTERVAL,
+                       help="seconds between two polls of the rubrics")
+    watch.add_argument("--sections-interval", type=float, default=DEFAULT_SECTIONS_INTERVAL,
+                       help="seconds between two updates of the sections")
+
+    serve = commands.add_parser(
+        "serve", help="serve heatmap images and matrices over HTTP")
+    _data_arguments(serve, nargs="*")
+    serve.add_argument("--section-to-teacher", metavar="FILENAME",
+                       help="JSON map of section names to teachers (for sectionsLeaders)")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8050)
+    serve.add_argument("--max-assignments", type=int, default=16,
+                       help="assignments kept in memory")
+    serve.add_argument("--max-renders", type=int, default=256,
+                       help="rendered heatmaps kept in memory")
+    serve.add_argument("--refresh-interval", type=float, default=300.0,
+                       help="seconds between two updates of an assignment")
+
+    return parser
+
+#########################################################################
+
+
+class HeatmapRenderer(object):
+    """
+    Exports the heatmaps of assignments, skipping those whose counts (and
+    rendering options) did not change since they were last exported.
+    """
+
+    def __init__(self, axes, directory=".", format="png", section_to_teacher=None,
+                 **kwargs):
+        self._axes = axes
+        self._directory = directory
+        self._format = format
+        self._section_to_teacher = section_to_teacher
+        self._kwargs = kwargs
+        self._digests = {}
+
+    def render(self, hmapdatas):
+        """
+        Export the heatmaps of `hmapdatas` (a map of assignment IDs to
+        `HeatmapData`) which changed, and return their filenames.
+        """
+        from . import draw as _draw
+
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+
+        jobs = []
+        for job in _draw.build_export_jobs(
+                hmapdatas, self._axes, directory=self._directory, format=self._format,
+                section_to_teacher=self._section_to_teacher, **self._kwargs):
+            digest = job.data.digest()
+            if self._digests.get(job.filename) == digest:
+                continue
+            self._digests[job.filename] = digest
+            jobs.append(job)
+
+        # The process pool only pays off for several images
+        if len(jobs) > 1:
+            _draw.export_heatmaps(jobs)
+        elif len(jobs) == 1:
+            _draw.export_heatmap(**jobs[0]._asdict())
+
+        return [ job.filename for job in jobs ]
+
+def _load(args):
+    return dict(
+        (assignment_id, HeatmapData(
+            assignment_id=assignment_id,
+            cache=args.cache,
+            max_workers=args.max_workers,
+            prefetch=args.prefetch))
+        for assignment_id in args.assignment_ids)
+
+def _renderer(args):
+    return HeatmapRenderer(
+        axes=[ parse_axes(value) for value in (args.axes or DEFAULT_AXES) ],
+        directory=args.directory,
+        format=args.format,
+        section_to_teacher=load_section_to_teacher(args.section_to_teacher),
+        max_rows=args.max_rows,
+        rows_per_page=args.rows_per_page)
+
+def render(args):
+    renderer = _renderer(args)
+    for filename in renderer.render(_load(args)):
+        print(filename)
+    return 0
+
+def watch(args, polls=None):
+    """
+    Poll the rubrics every `args.interval` seconds (forever, or `polls`
+    times), and refresh and re-render the assignments whose rubric changed.
+    """
+    renderer = _renderer(args)
+    hmapdatas = _load(args)
+    for filename in renderer.render(hmapdatas):
+        _logger.info("Rendered {}".format(filename))
+
+    t_sections = dict((assignment_id, time.time()) for assignment_id in hmapdatas)
+    poll = 0
+    while polls == None or poll < polls:
+        poll += 1
+        time.sleep(args.interval)
+
+        changed = {}
+        for (assignment_id, hmapdata) in hmapdatas.items():
+            sections = time.time() - t_sections[assignment_id] >= args.sections_interval
+            try:
+                # Nothing new: no other request, nothing to compute
+                if not hmapdata.update(sections=sections):
+                    continue
+            except Exception as exc:
+                _logger.warning("Assignment {}: {}".format(assignment_id, exc))
+                continue
+
+            if sections:
+                t_sections[assignment_id] = time.time()
+            if args.cache:
+                hmapdata._store_cache()
+            _logger.info("Assignment {}: {} comments added, {} removed".format(
+                assignment_id, hmapdata._c_refresh_added, hmapdata._c_refresh_removed))
+            changed[assignment_id] = hmapdata
+
+        if len(changed) > 0:
+            for filename in renderer.render(changed):
+                _logger.info("Rendered {}".format(filename))
+
+    return 0
+
+def serve(args):
+    from . import server as _server
+    _server.serve(
+        host=args.host,
+        port=args.port,
+        assignment_ids=args.assignment_ids,
+        max_assignments=args.max_assignments,
+        max_renders=args.max_renders,
+        refresh_interval=args.refresh_interval,
+        section_to_teacher=load_section_to_teacher(args.section_to_teacher),
+        cache=args.cache,
+        max_workers=args.max_workers,
+        prefetch=args.prefetch)
+    return 0
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    _util.setupLogging()
+
+    # Draw without a display
+    os.environ.setdefault("MPLBACKEND", "Agg")
+
+    try:
+        if args.command == "render":
+            return render(args)
+        if args.command == "watch":
+            return watch(args)
+        if args.command == "serve":
+            return serve(args)
+    except argparse.ArgumentTypeError as exc:
+        # The axes are only parsed once the aggregation is imported
+        parser.error(str(exc))
+    except KeyboardInterrupt:
+        return 130
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
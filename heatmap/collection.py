@@ -0,0 +1,133 @@
+
+# Python dependencies
+#
+from __future__ import print_function # Python 2
+#
+import collections as collections
+import time as time
+
+# Python 3 (Python 2 requires the 'futures' backport)
+import concurrent.futures as _futures
+
+# Local dependencies
+#
+from . import util as _util
+from . import fetch as _fetch
+from .preprocess import HeatmapData as HeatmapData
+
+#########################################################################
+
+
+_logger = _util.getLogger()
+
+#########################################################################
+
+
+def _load_assignment(assignment_id, kwargs):
+    # Entry point of the worker processes (must be a module-level function)
+    return HeatmapData(assignment_id=assignment_id, **kwargs)
+
+class HeatmapCollection(object):
+    """
+    Loads the `HeatmapData` of several assignments (typically all those of
+    a course) in parallel.
+
+    With threads (the default), the assignments share a request memo while
+    they are loaded, so that the course and its sections are only fetched
+    once (later refreshes do not use it, see `HeatmapData.refresh`). With
+    `processes=True`, the assignments are loaded in separate worker
+    processes, which share the course and sections through a
+    `ResponseStore` instead (`DEFAULT_STORE_FILENAME` unless one is given).
+
+    Each assignment has its own rate limiter (`rate_limit`), so that the
+    total time is bounded by the slowest assignment, at the cost of up to
+    `len(assignment_ids) * rate_limit` requests per second overall: to bound
+    the overall rate instead, pass a shared `limiter=fetch.TokenBucket(...)`.
+
+    Additional keyword arguments are passed to each `HeatmapData`.
+    """
+
+    def __init__(self, assignment_ids, max_workers=None, processes=False, **kwargs):
+        self._assignment_ids = list(assignment_ids)
+        self._max_workers = max_workers or max(1, len(self._assignment_ids))
+        self._processes = processes
+
+        if kwargs.get("api_key") == None:
+            kwargs["api_key"] = _util.configure_apikey()
+
+        if processes:
+            if kwargs.get("response_store") == None:
+                kwargs["response_store"] = _fetch.DEFAULT_STORE_FILENAME
+
+        self._kwargs = kwargs
+        self._map_assignment_id_to_data = collections.OrderedDict()
+
+        self.init()
+
+    def init(self):
+        self._t_init_start = time.time()
+
+        if self._processes:
+            executor_class = _futures.ProcessPoolExecutor
+        else:
+            executor_class = _futures.ThreadPoolExecutor
+
+        # The memo is only shared by this batch of initializations: it would
+        # otherwise serve stale objects to later refreshes, and keep all the
+        # files and submissions in memory
+        kwargs = dict(self._kwargs)
+        if not self._processes:
+            kwargs.setdefault("memo", _fetch.RequestMemo())
+
+        with executor_class(max_workers=self._max_workers) as executor:
+            futures = [
+                executor.submit(_load_assignment, assignment_id, kwargs)
+                for assignment_id in self._assignment_ids
+            ]
+
+            self._map_assignment_id_to_data = collections.OrderedDict()
+            for (assignment_id, future) in zip(self._assignment_ids, futures):
+                hmapdata = future.result()
+                hmapdata._detach_memo()
+                self._map_assignment_id_to_data[assignment_id] = hmapdata
+
+        self._t_init_end = time.time()
+        self._t_init_duration = (self._t_init_end - self._t_init_start)
+
+        _logger.debug("Loaded {} assignments in {:.1f}s".format(
+            len(self._assignment_ids), self._t_init_duration))
+
+    def __len__(self):
+        return len(self._map_assignment_id_to_data)
+
+    def __iter__(self):
+        return iter(self._map_assignment_id_to_data)
+
+    def __getitem__(self, assignment_id):
+        return self._map_assignment_id_to_data[assignment_id]
+
+    def items(self):
+        return self._map_assignment_id_to_data.items()
+
+    def values(self):
+        return self._map_assignment_id_to_data.values()
+
+    def get_durations(self):
+        """
+        Return the initialization time (in seconds) of each assignment, or
+        `None` for the assignments that were loaded from their cache.
+        """
+        return collections.OrderedDict(
+            (assignment_id, getattr(hmapdata, "_t_init_duration", None))
+            for (assignment_id, hmapdata) in self.items())
+
+    def get_statistics(self):
+        durations = [ d for d in self.get_durations().values() if d != None ]
+        return {
+            "assignments": len(self),
+            "duration": self._t_init_duration,
+            "duration_sum": sum(durations),
+            "duration_max": max(durations) if len(durations) > 0 else None,
+            "get_total": sum(getattr(h, "_c_get_total", 0) for h in self.values()),
+            "get_err": sum(getattr(h, "_c_get_err", 0) for h in self.values()),
+        }
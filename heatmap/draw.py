@@ -3,8 +3,13 @@
 #
 from __future__ import print_function # Python 2
 #
+import collections as collections
+import io as io
 import os as os
 
+# Python 3 (Python 2 requires the 'futures' backport)
+import concurrent.futures as _futures
+
 # External dependencies
 #
 import pandas as _pd               # Package to manipulate tables of data
@@ -12,35 +17,35 @@ import seaborn as _sns             # Package to create visual heatmap
 import matplotlib.pyplot as _plt   # Package to plot heatmap
 import numpy as _np                # array() to tweak the palette
 
+# Headless rendering (see `export_heatmap`)
+from matplotlib.figure import Figure as _Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg as _FigureCanvasAgg
+
 # Local dependencies
 #
 from . import util as _util
+from . import aggregate as _aggregate
+from . import stats as _stats
 from .preprocess import HeatmapData as HeatmapData
+from .aggregate import HeatmapXAxis as HeatmapXAxis
+from .aggregate import HeatmapYAxis as HeatmapYAxis
+from .aggregate import HeatmapMatrix as HeatmapMatrix
+from .aggregate import SparseHeatmapMatrix as SparseHeatmapMatrix
 
 #########################################################################
 
 
 _logger = _util.getLogger()
 
-#########################################################################
-
-
-class HeatmapXAxis(_util.DocEnum):
-    """
-    Describes all possible selectable data points for the heatmap's x-axis.
-    """
-
-    GRADERS = "graders", """Individual graders."""
-    SECTIONS = "sections", """Course sections."""
-    TEACHERS = "sectionsLeaders", """Section leaders."""
+DEFAULT_FIGSIZE = (20.7, 15.27)
+EXPORT_FORMATS = ("png", "svg", "pdf")
 
-class HeatmapYAxis(_util.DocEnum):
-    """
-    Describes all possible selectable data points for the heatmap's y-axis.
-    """
+# Beyond these numbers of cells, the heatmap is drawn without annotations
+# (one text artist per cell), and as a single image rather than vector cells
+DEFAULT_ANNOT_MAX_CELLS = 2500
+DEFAULT_RASTERIZE_MIN_CELLS = 10000
 
-    COMMENTS = "rubricComments", """Individual rubric comments (caption, ID)."""
-    CATEGORIES = "rubricCategories", """Rubric categories (caption)."""
+OTHER_ROWS_LABEL = "(other)"
 
 #########################################################################
 
@@ -61,59 +66,45 @@ def axis_to_string(mode):
 def build_heatmap(hmapdata: HeatmapData,
                   x: HeatmapXAxis =HeatmapXAxis.GRADERS,
                   y: HeatmapYAxis =HeatmapYAxis.COMMENTS,
-                  section_to_teacher=None):
+                  section_to_teacher=None,
+                  format="dict"):
     """
-    """
-    heatmap = {}
-
-    for (comment_id, comment_obj) in hmapdata.get_comments().items():
+    Count the comments of `hmapdata` by x-axis and y-axis key.
 
-        rubricComment_obj = comment_obj["rubricComment"]
+    With `format="dict"`, returns a map of x-axis keys to maps of y-axis
+    keys to counts. With `format="matrix"` (or `"sparse"`), the counts are
+    computed by the vectorized engine (see `aggregate.build_heatmap_matrix`)
+    and returned as a `HeatmapMatrix` (or `SparseHeatmapMatrix`); `hmapdata`
+    may then also be a list of `HeatmapData`. With `format="estimate"`, the
+    counts of a sampled `HeatmapData` are scaled into a `HeatmapEstimate`
+    (see `aggregate.estimate_heatmap`).
+    """
+    if format not in ("dict", "matrix", "sparse", "estimate"):
+        raise ValueError("Unknown heatmap format: {}".format(format))
+    
+    with _stats.phase(hmapdata, "build_heatmap"):
+        if format == "estimate":
+            return _aggregate.estimate_heatmap(
+                hmapdata, x=x, y=y, section_to_teacher=section_to_teacher)
         
-        # COMPUTE X-AXIS
-        # Keys must be plural to support sections (multiple per assignment
-        # since students from different sections could partner)
-        keys = []
-        if x == HeatmapXAxis.GRADERS:
-            keys = [ comment_obj["author"] ]
+        if format in ("matrix", "sparse"):
+            return _aggregate.build_heatmap_matrix(
+                hmapdata, x=x, y=y, section_to_teacher=section_to_teacher,
+                sparse=(format == "sparse"))
         
-        elif x == HeatmapXAxis.SECTIONS:
-            keys = comment_obj["sections"]
+        accumulator = _aggregate.HeatmapAccumulator(
+            x=x, y=y, section_to_teacher=section_to_teacher)
+        accumulator.update(hmapdata.iter_comments())
         
-        elif x == HeatmapXAxis.TEACHERS:
-            
-            if section_to_teacher == None:
-                raise ValueError(
-                    "'section_to_teacher' needs to be defined for TEACHERS")
-            
-            # Resolve the teachers from the sections
-            keys = list(set(
-                map(lambda s: section_to_teacher.get(s, ""),
-                    comment_obj["sections"])))
-            
-        # COMPUTE Y-AXIS
-        if y == HeatmapYAxis.COMMENTS:
-            value = (rubricComment_obj["text"], rubricComment_obj["id"])
-            
-        elif y == HeatmapYAxis.CATEGORIES:
-            value = comment_obj["category"]
-
-        # INSERT
-        # Insert in heatmap assuming multiple keys (typically only one)
-        for key in keys:
-            heatmap[key] = heatmap.get(key, dict())
-            heatmap[key][value] = heatmap[key].get(value, 0) + 1
-    
-    return heatmap
-
-def render_heatmap_data(data,
-                  x: HeatmapXAxis =HeatmapXAxis.GRADERS,
-                  y: HeatmapYAxis =HeatmapYAxis.COMMENTS,
-                  x_caption=None,
-                  y_caption=None):
+        return accumulator.to_dict()
 
+def _heatmap_dataframe(data):
     # Convert adequately formatted heatmap data into a dataframe
-    dataframe = _pd.DataFrame(data)
+    if isinstance(data, (HeatmapMatrix, SparseHeatmapMatrix)):
+        # Sparse heatmaps are only made dense here
+        dataframe = data.to_dataframe()
+    else:
+        dataframe = _pd.DataFrame(data)
 
     # Destructively fill in zeroes for missing fields (where there are no comments)
     dataframe.fillna(0, inplace=True)
@@ -121,20 +112,245 @@ def render_heatmap_data(data,
     dataframe.rename(columns=lambda x: x.split("@")[0],inplace=True) # strip out netID for plot simplicity
     dataframe = dataframe.reindex(sorted(dataframe.columns), axis=1) # sort columns
 
-    # Set a larger figure size for visibiliy
-    _sns.set(rc={'figure.figsize':(20.7,15.27)})
+    return dataframe
+
+def _limit_rows(dataframe, max_rows):
+    # Keep the rows with the most comments, and collapse the others into one
+    if max_rows == None or len(dataframe) <= max_rows:
+        return dataframe
+    
+    # (Absolute values: the counts of a delta heatmap may be negative)
+    totals = dataframe.abs().sum(axis=1).sort_values(ascending=False, kind="stable")
+    top = dataframe.loc[totals.index[:max_rows - 1]]
+    other = dataframe.loc[totals.index[max_rows - 1:]].sum(axis=0)
     
-    # Set palette as greens, but with a white for zero
-    palette = [ _np.array([1.0, 1. , 1.0, 1. ]) ] + _sns.light_palette("green")
+    # Rubric comments are indexed by (text, ID)
+    if isinstance(dataframe.index, _pd.MultiIndex):
+        label = (OTHER_ROWS_LABEL,) + ("",) * (dataframe.index.nlevels - 1)
+    else:
+        label = OTHER_ROWS_LABEL
+    
+    other = _pd.DataFrame([other.values], columns=dataframe.columns,
+                          index=_pd.Index([label]))
+    return _pd.concat([top, other])
 
-    # Make plot
-    _sns.heatmap(dataframe, cmap=palette, cbar_kws={"label": "# of Comments"}, annot=True)
+def _paginate(dataframe, rows_per_page):
+    if rows_per_page == None or len(dataframe) <= rows_per_page:
+        return [ dataframe ]
+    return [
+        dataframe.iloc[start:start + rows_per_page]
+        for start in range(0, len(dataframe), rows_per_page)
+    ]
 
+def _heatmap_pages(data, max_rows=None, rows_per_page=None):
+    """
+    Return the list of dataframes to draw, one per figure.
+    
+    To get fewer, larger rows, aggregate the heatmap by category
+    (`HeatmapYAxis.CATEGORIES`) rather than by rubric comment.
+    """
+    dataframe = _limit_rows(_heatmap_dataframe(data), max_rows)
+    return _paginate(dataframe, rows_per_page)
+
+def _draw_heatmap(ax, dataframe, x, y, x_caption=None, y_caption=None, annot=None,
+                  diverging=False):
     # Label axes with standard caption if necessary
     x_caption = x_caption or axis_to_string(x)
-    y_caption = y_caption or axis_to_string(y)
-    _plt.xlabel(x_caption)
-    _plt.ylabel(y_caption or "Rubric Comment Text --- ID")
+    y_caption = y_caption or axis_to_string(y) or "Rubric Comment Text --- ID"
+    
+    # Nothing to draw (typically the delta of two identical snapshots),
+    # which seaborn cannot scale a palette for
+    if dataframe.size == 0:
+        ax.text(0.5, 0.5, "No changes" if diverging else "No comments",
+                ha="center", va="center", transform=ax.transAxes)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        ax.set_xlabel(x_caption)
+        ax.set_ylabel(y_caption)
+        return
+    
+    if diverging:
+        # Signed counts (see `snapshot.SnapshotDiff.delta`): white for zero,
+        # red for fewer comments and green for more
+        palette = _sns.diverging_palette(10, 130, as_cmap=True)
+        options = {"center": 0, "cbar_kws": {"label": "Change in # of Comments"}}
+    else:
+        # Set palette as greens, but with a white for zero
+        palette = [ _np.array([1.0, 1. , 1.0, 1. ]) ] + _sns.light_palette("green")
+        options = {"cbar_kws": {"label": "# of Comments"}}
+
+    # Large matrices: annotations take minutes to draw and are unreadable,
+    # and vector output with one path per cell is huge
+    cells = dataframe.shape[0] * dataframe.shape[1]
+    if annot == None:
+        annot = cells <= DEFAULT_ANNOT_MAX_CELLS
+    rasterized = cells >= DEFAULT_RASTERIZE_MIN_CELLS
+
+    # Make plot
+    _sns.heatmap(dataframe, ax=ax, cmap=palette, annot=annot, rasterized=rasterized,
+                 **options)
+
+    ax.set_xlabel(x_caption)
+    ax.set_ylabel(y_caption)
+
+def render_heatmap_data(data,
+                  x: HeatmapXAxis =HeatmapXAxis.GRADERS,
+                  y: HeatmapYAxis =HeatmapYAxis.COMMENTS,
+                  x_caption=None,
+                  y_caption=None,
+                  annot=None,
+                  max_rows=None,
+                  rows_per_page=None,
+                  instrumentation=None,
+                  diverging=False):
+    """
+    Plot a heatmap (as returned by `build_heatmap`).
+    
+    With `diverging=True`, the counts may be negative (such as the delta of
+    two snapshots), and are drawn with a palette centered on zero.
+    
+    Large heatmaps are drawn without annotations unless `annot` is set.
+    Only the `max_rows` rows with the most comments are drawn (the others
+    are collapsed into a single row), and the rows are split into several
+    figures of `rows_per_page` rows.
+
+    The drawing time is recorded as the "render" phase of `instrumentation`
+    (such as the one of a `HeatmapData`), if provided.
+    """
+
+    with _stats.phase(instrumentation, "render"):
+        pages = _heatmap_pages(data, max_rows=max_rows, rows_per_page=rows_per_page)
+
+        # Set a larger figure size for visibiliy
+        _sns.set(rc={'figure.figsize':DEFAULT_FIGSIZE})
+        
+        for (index, dataframe) in enumerate(pages):
+            if index > 0:
+                _plt.figure()
+            _draw_heatmap(_plt.gca(), dataframe, x=x, y=y,
+                          x_caption=x_caption, y_caption=y_caption, annot=annot,
+                          diverging=diverging)
 
     #plt.tight_layout()
     _plt.show()
+
+#########################################################################
+
+
+def export_heatmap(data,
+                   filename=None,
+                   format=None,
+                   x: HeatmapXAxis =HeatmapXAxis.GRADERS,
+                   y: HeatmapYAxis =HeatmapYAxis.COMMENTS,
+                   x_caption=None,
+                   y_caption=None,
+                   figsize=DEFAULT_FIGSIZE,
+                   dpi=100,
+                   annot=None,
+                   max_rows=None,
+                   rows_per_page=None,
+                   instrumentation=None,
+                   diverging=False):
+    """
+    Render a heatmap (as accepted by `render_heatmap_data`) to an image,
+    without a display: the figure is drawn on its own `Figure` with the
+    non-interactive Agg canvas, leaving the global pyplot state untouched.
+
+    The `format` ("png", "svg" or "pdf") defaults to the extension of
+    `filename`. Returns `filename`, or the image as bytes if no filename is
+    given. When the heatmap is split in several pages (see
+    `render_heatmap_data`), returns a list, and the page number is added to
+    the filenames.
+
+    The rendering time is recorded as the "render" phase of
+    `instrumentation`, if provided.
+    """
+    if format == None:
+        format = os.path.splitext(filename)[1][1:].lower() if filename else "png"
+    if format not in EXPORT_FORMATS:
+        raise ValueError("Unsupported image format: {}".format(format))
+
+    pages = _heatmap_pages(data, max_rows=max_rows, rows_per_page=rows_per_page)
+
+    results = []
+    with _stats.phase(instrumentation, "render"):
+        for (index, dataframe) in enumerate(pages):
+            page_filename = filename
+            if filename and len(pages) > 1:
+                (root, ext) = os.path.splitext(filename)
+                page_filename = "{}_p{}{}".format(root, index + 1, ext)
+
+            results.append(_export_page(
+                dataframe, filename=page_filename, format=format, x=x, y=y,
+                x_caption=x_caption, y_caption=y_caption,
+                figsize=figsize, dpi=dpi, annot=annot, diverging=diverging))
+
+    return results[0] if len(results) == 1 else results
+
+def _export_page(dataframe, filename, format, x, y, x_caption, y_caption, figsize, dpi, annot,
+                 diverging):
+    figure = _Figure(figsize=figsize, dpi=dpi)
+    _FigureCanvasAgg(figure)
+
+    # Same style as `render_heatmap_data`, but only while drawing
+    with _sns.axes_style("darkgrid"), _sns.plotting_context("notebook"):
+        ax = figure.add_subplot(1, 1, 1)
+        _draw_heatmap(ax, dataframe, x=x, y=y,
+                      x_caption=x_caption, y_caption=y_caption, annot=annot,
+                      diverging=diverging)
+
+        if filename:
+            figure.savefig(filename, format=format)
+            return filename
+
+        buffer = io.BytesIO()
+        figure.savefig(buffer, format=format)
+        return buffer.getvalue()
+
+class ExportJob(collections.namedtuple(
+        "ExportJob", ["data", "filename", "format", "x", "y", "x_caption", "y_caption",
+                      "annot", "max_rows", "rows_per_page", "diverging"])):
+    """
+    Arguments of one call to `export_heatmap` in `export_heatmaps`.
+    """
+
+    def __new__(cls, data, filename=None, format=None,
+                x=HeatmapXAxis.GRADERS, y=HeatmapYAxis.COMMENTS,
+                x_caption=None, y_caption=None,
+                annot=None, max_rows=None, rows_per_page=None, diverging=False):
+        return super(ExportJob, cls).__new__(
+            cls, data, filename, format, x, y, x_caption, y_caption,
+            annot, max_rows, rows_per_page, diverging)
+
+def _export_job(job):
+    # Entry point of the worker processes (must be a module-level function)
+    return export_heatmap(**job._asdict())
+
+def export_heatmaps(jobs, max_workers=None):
+    """
+    Render a list of `ExportJob` in parallel worker processes (each figure
+    is independent), and return their results in the same order.
+    """
+    with _futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_export_job, jobs))
+
+def build_export_jobs(hmapdatas, axes, directory=".", format="png", section_to_teacher=None,
+                      **kwargs):
+    """
+    Create the `ExportJob` of every `(x, y)` pair of `axes` for every
+    assignment of `hmapdatas` (a map of assignment IDs to `HeatmapData`,
+    such as a `HeatmapCollection`). The heatmaps are aggregated here, so
+    that only the count matrices are sent to the worker processes.
+
+    Additional keyword arguments (`annot`, `max_rows`, ...) are set on every
+    job.
+    """
+    jobs = []
+    for (assignment_id, hmapdata) in hmapdatas.items():
+        for (x, y) in axes:
+            filename = os.path.join(directory, "heatmap_{}_{}_{}.{}".format(
+                assignment_id, x.value, y.value, format))
+            data = build_heatmap(
+                hmapdata, x=x, y=y, section_to_teacher=section_to_teacher, format="matrix")
+            jobs.append(ExportJob(data=data, filename=filename, format=format, x=x, y=y, **kwargs))
+    return jobs
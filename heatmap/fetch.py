@@ -0,0 +1,307 @@
+
+# Python dependencies
+#
+from __future__ import print_function # Python 2
+#
+import json as json
+import random as random
+import re as re
+import sqlite3 as sqlite3
+import threading as threading
+import time as time
+
+# Python 3 (Python 2 requires the 'futures' backport)
+import concurrent.futures as _futures
+
+# External dependencies
+#
+import requests as _requests
+import requests.adapters as _requests_adapters
+
+# Local dependencies
+#
+from . import util as _util
+
+#########################################################################
+
+
+_logger = _util.getLogger()
+
+DEFAULT_RATE_LIMIT = 100.0  # Requests per second
+DEFAULT_MIN_RATE_LIMIT = 1.0
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_MAX_BACKOFF = 60.0  # Seconds
+
+# Status codes that signal the API is overloaded, and the request should
+# be retried later (rather than counted as an error)
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+DEFAULT_STORE_FILENAME = "codePost_heatmap_responses.sqlite3"
+DEFAULT_STORE_MAX_ENTRIES = 10000
+
+# Time-to-live (in seconds) of the responses kept in a `ResponseStore`, by
+# endpoint; responses of endpoints which are not listed are never stored.
+# The rubric changes while grading: it is never stored, but polled with
+# conditional requests instead (see `HeatmapData.poll_rubric`).
+DEFAULT_STORE_TTLS = [
+    (r"^/courses/\d+/$", 24 * 3600),
+    (r"^/sections/\d+/$", 24 * 3600),
+    (r"^/assignments/\d+/$", 3600),
+]
+
+#########################################################################
+
+
+def make_session(pool_size):
+    """
+    Return a `requests.Session` keeping up to `pool_size` connections
+    alive, so that concurrent requests reuse TCP/TLS connections.
+    """
+    session = _requests.Session()
+    adapter = _requests_adapters.HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def backoff_delay(attempt, retry_after=None, max_delay=DEFAULT_MAX_BACKOFF):
+    """
+    Return how long to wait before retry number `attempt` (starting at 0):
+    the server's `Retry-After` header if it is provided, or else a jittered
+    exponential delay.
+    """
+    if retry_after != None:
+        try:
+            return min(max_delay, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    return min(max_delay, (2 ** attempt) * (0.5 + random.random()))
+
+#########################################################################
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token-bucket rate limiter with an adaptive rate: the rate is
+    halved whenever the API pushes back (`backoff`) and then ramps back up
+    linearly with every successful request (`recover`), up to `rate`.
+
+    Concurrent requests tend to be rejected together, so the rate is halved
+    at most once every `cooldown` seconds.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE_LIMIT, burst=None, min_rate=DEFAULT_MIN_RATE_LIMIT,
+                 cooldown=1.0):
+        self._max_rate = float(rate)
+        self._min_rate = min(float(min_rate), self._max_rate)
+        self._rate = self._max_rate
+        self._burst = float(burst or max(1.0, self._max_rate))
+        self._tokens = self._burst
+        self._t_last = time.time()
+        self._t_backoff = None
+        self._cooldown = cooldown
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self._burst, self._tokens + (now - self._t_last) * self._rate)
+        self._t_last = now
+
+    def acquire(self):
+        """
+        Block until a request may be sent.
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self._rate
+            time.sleep(wait)
+
+    def backoff(self):
+        with self._lock:
+            self._refill()
+            now = time.time()
+            if self._t_backoff == None or now - self._t_backoff >= self._cooldown:
+                self._t_backoff = now
+                self._rate = max(self._min_rate, self._rate / 2.0)
+            # Drain the bucket, so that the bursts stop immediately
+            self._tokens = min(self._tokens, 0.0)
+
+    def recover(self):
+        with self._lock:
+            if self._rate < self._max_rate:
+                self._refill()
+                self._rate = min(self._max_rate, self._rate + self._max_rate / 100.0)
+
+#########################################################################
+
+
+class RequestMemo(object):
+    """
+    Memoizes the result of API requests by key (typically the endpoint,
+    which includes the object ID), and coalesces concurrent requests for
+    the same key, so that only the first caller performs the request and
+    all others wait for and share its result.
+
+    Failed requests (returning `None`) are not memoized.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def get(self, key, func):
+        """
+        Return the memoized result for `key`, calling `func()` to compute it
+        if necessary. Returns a pair `(result, hit)` where `hit` indicates
+        whether the result was shared rather than computed by this call.
+        """
+        with self._lock:
+            future = self._entries.get(key)
+            owner = future == None
+            if owner:
+                future = _futures.Future()
+                self._entries[key] = future
+
+        if not owner:
+            return (future.result(), True)
+
+        try:
+            result = func()
+        except BaseException as exc:
+            with self._lock:
+                self._entries.pop(key, None)
+            future.set_exception(exc)
+            raise
+
+        if result == None:
+            with self._lock:
+                self._entries.pop(key, None)
+
+        future.set_result(result)
+        return (result, False)
+
+#########################################################################
+
+
+class ResponseStore(object):
+    """
+    On-disk (SQLite) store of API responses, keyed by endpoint, shared by
+    all `HeatmapData` objects (and processes) using the same file. Each
+    response expires after the time-to-live of the first pattern of `ttls`
+    matching its endpoint, and the least recently used responses are
+    evicted beyond `max_entries`.
+    """
+
+    def __init__(self, filename=DEFAULT_STORE_FILENAME, ttls=None,
+                 max_entries=DEFAULT_STORE_MAX_ENTRIES):
+        self._filename = filename
+        self._ttls = [
+            (re.compile(pattern), ttl)
+            for (pattern, ttl) in (ttls if ttls != None else DEFAULT_STORE_TTLS)
+        ]
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connect()
+
+    def _connect(self):
+        self._db = sqlite3.connect(self._filename, timeout=30, check_same_thread=False)
+        with self._lock:
+            with self._db:
+                # Concurrent readers across processes
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    " endpoint TEXT PRIMARY KEY,"
+                    " body TEXT NOT NULL,"
+                    " t_stored REAL NOT NULL,"
+                    " t_accessed REAL NOT NULL)")
+                self._db.execute(
+                    "CREATE INDEX IF NOT EXISTS responses_t_accessed"
+                    " ON responses (t_accessed)")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_lock", None)
+        state.pop("_db", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._connect()
+
+    def ttl(self, endpoint):
+        """
+        Return the time-to-live of the responses of `endpoint`, or `None` if
+        they should not be stored.
+        """
+        for (pattern, ttl) in self._ttls:
+            if pattern.match(endpoint):
+                return ttl
+        return None
+
+    def get(self, endpoint):
+        ttl = self.ttl(endpoint)
+        if ttl == None:
+            return None
+
+        now = time.time()
+        with self._lock:
+            with self._db:
+                row = self._db.execute(
+                    "SELECT body, t_stored FROM responses WHERE endpoint = ?",
+                    (endpoint,)).fetchone()
+                if row == None:
+                    return None
+                if now - row[1] > ttl:
+                    self._db.execute(
+                        "DELETE FROM responses WHERE endpoint = ?", (endpoint,))
+                    return None
+                self._db.execute(
+                    "UPDATE responses SET t_accessed = ? WHERE endpoint = ?",
+                    (now, endpoint))
+        return json.loads(row[0])
+
+    def put(self, endpoint, obj):
+        if self.ttl(endpoint) == None:
+            return
+
+        now = time.time()
+        body = json.dumps(obj, separators=(",", ":"))
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                    (endpoint, body, now, now))
+                (count,) = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()
+                if count > self._max_entries:
+                    self._db.execute(
+                        "DELETE FROM responses WHERE endpoint IN ("
+                        " SELECT endpoint FROM responses"
+                        " ORDER BY t_accessed LIMIT ?)",
+                        (count - self._max_entries,))
+
+    def clear(self):
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM responses")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
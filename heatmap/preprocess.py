@@ -3,11 +3,22 @@
 #
 from __future__ import print_function # Python 2
 #
+import contextlib as contextlib
 import copy as copy
 import functools as functools
+import hashlib as hashlib
+import itertools as itertools
 import json as json
+import math as math
 import os as os
+import random as random
+import sys as sys
+import threading as threading
 import time as time
+import types as types
+
+# Python 3 (Python 2 requires the 'futures' backport)
+import concurrent.futures as _futures
 
 try:
     # Python 3
@@ -16,26 +27,62 @@ except ImportError:
     # Python 2
     from urlparse import urljoin
 
-# External dependencies
-#
-import requests as _requests
-
 # Local dependencies
 #
 from . import util as _util
+from . import fetch as _fetch
+from . import cache as _cache
+from . import stats as _stats
 
 #########################################################################
 
 
 _logger = _util.getLogger()
 
+DEFAULT_MAX_WORKERS = 8
+
 #########################################################################
 
 
+def _gauge_name(name):
+    # Per-run values of `HeatmapData.stats`, e.g. "stream_total" (the number
+    # of comments to fetch), as gauges: only counters end with "_total"
+    if name.endswith("_total"):
+        name = name[:-len("_total")] + "_size"
+    return "last_{}".format(name)
+
 class HeatmapData(object):
     
-    def __init__(self, assignment_id, cache=True, refresh_cache=False, cache_filename=None, api_key=None):
+    def __init__(self, assignment_id, cache=True, refresh_cache=False, cache_filename=None, api_key=None,
+                 max_workers=DEFAULT_MAX_WORKERS, prefetch=False, pool_size=None,
+                 rate_limit=_fetch.DEFAULT_RATE_LIMIT, max_retries=_fetch.DEFAULT_MAX_RETRIES,
+                 update_cache=False, response_store=None, memo=None, limiter=None,
+                 load=True, journal=None, instrumentation=None, base_url=None,
+                 sample=None, store_cube=None):
         self._assignment_id = assignment_id
+        self._store_cube = store_cube
+        self._base_url = base_url
+        self._max_workers = max_workers
+        self._prefetch = prefetch
+        self._max_retries = max_retries
+        self._pool_size = pool_size or max(1, max_workers)
+        self._rate_limit = rate_limit
+        self._lock = threading.Lock()
+        self._session = _fetch.make_session(self._pool_size)
+        
+        # The memo and rate limiter may be shared by several assignments
+        # (see `HeatmapCollection`), in which case the memo outlives this run
+        self._memo_shared = memo != None
+        self._memo = memo if memo != None else _fetch.RequestMemo()
+        self._limiter = limiter if limiter != None else _fetch.TokenBucket(rate=rate_limit)
+        
+        # Per-endpoint and per-phase statistics, and profiling hooks
+        self._instrumentation = instrumentation or _stats.Instrumentation()
+        
+        # Responses (course, sections, ...) shared with other assignments
+        if isinstance(response_store, str):
+            response_store = _fetch.ResponseStore(filename=response_store)
+        self._store = response_store
 
         if api_key == None:
             api_key = _util.configure_apikey()
@@ -43,96 +90,555 @@ class HeatmapData(object):
         self._headers = {"Authorization": "Token " + api_key}
         
         self._map_comments_id_to_cache = {}
+        self._derived = {}
+        
+        # Cumulative counters (see `_count`): unlike the `_c_*` counters of
+        # the last initialization or refresh, they are never reset
+        self._counters_total = {}
+        
+        # Record the comments as they are fetched, to resume an interrupted
+        # initialization (by default, whenever the cache is used)
+        self._journal_filename = None
+        if journal if journal != None else cache:
+            self._journal_filename = self._default_journal_filename()
+            if refresh_cache:
+                _cache.Journal(self._journal_filename).remove()
+        
+        # Nothing to do yet, e.g. to `stream` the comments instead
+        if not load:
+            return
+        
         if cache and not refresh_cache:
             self._load_cache(filename=cache_filename)
         
         if len(self._map_comments_id_to_cache) == 0:
-            self.init()
+            self.init(sample=sample)
         
             if cache:
                 self._store_cache(filename=cache_filename)
+            
+            # Everything is now safely stored (or not wanted)
+            if self._journal_filename != None:
+                _cache.Journal(self._journal_filename).remove()
+        
+        # A cached sample (see `stream_rubric`) is completed by a refresh,
+        # which only fetches the comments missing from it
+        elif update_cache or (sample == None and self.is_partial()):
+            self.refresh()
+            
+            if cache:
+                self._store_cache(filename=cache_filename)
+    
+    def __getstate__(self):
+        # Locks, connections and in-flight requests cannot be pickled (to be
+        # sent back from worker processes), they are recreated instead
+        state = self.__dict__.copy()
+        for attribute in ["_lock", "_memo", "_session", "_limiter", "_executor"]:
+            state.pop(attribute, None)
+        state["_memo_shared"] = False
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._memo = _fetch.RequestMemo()
+        self._session = _fetch.make_session(self._pool_size)
+        self._limiter = _fetch.TokenBucket(rate=self._rate_limit)
     
     def _default_cache_filename(self):
         return "codePost_heatmap_cache_assignment_{}.json".format(
             self._assignment_id)
     
+    def _default_journal_filename(self):
+        return "codePost_heatmap_journal_assignment_{}.jsonl".format(
+            self._assignment_id)
+    
     def _load_cache(self, filename=None):
         if not filename:
             filename = self._default_cache_filename()
         try:
-            with open(filename) as f:
-                self._map_comments_id_to_cache = json.loads(f.read())
+            with self._instrumentation.phase("load_cache"):
+                (self._map_comments_id_to_cache, cube) = _cache.load_with_cube(filename)
         except:
-            self._map_comments_id_to_cache = {}
+            (self._map_comments_id_to_cache, cube) = ({}, None)
+        self._invalidate()
+        
+        # The count cube is only decoded when it is first used
+        if cube != None:
+            self._derived["cube_state"] = cube
+    
+    def _invalidate(self):
+        # Data structures derived from the comments (see `aggregate`)
+        self._derived = {}
     
     def _store_cache(self, filename=None):
         if not filename:
             filename = self._default_cache_filename()
-        with open(filename, "w") as f:
-            f.write(json.dumps(self._map_comments_id_to_cache, indent=2))
+        with self._instrumentation.phase("store_cache"):
+            _cache.store(filename, self._map_comments_id_to_cache, cube=self._cube_state())
+    
+    def _cube_state(self):
+        # State of the count cube, built once the comments are all there.
+        # The aggregation module depends on numpy: unless asked to
+        # (`store_cube=True`), the cube is only built if it is already
+        # imported, and otherwise built from the comments when first used
+        state = self._derived.get("cube_state")
+        if self._store_cube == None:
+            build = (__package__ + ".aggregate") in sys.modules
+        else:
+            build = self._store_cube
+        if state == None and build and len(self._map_comments_id_to_cache) > 0:
+            from . import aggregate as _aggregate
+            state = _aggregate.comment_cube(self).to_state()
+            self._derived["cube_state"] = state
+        return state
+    
+    def _reset_statistics(self):
+        self._c_get_total = 0
+        self._c_get_err = 0
+        self._c_get_exc = 0
+        self._c_get_retry = 0
+        self._c_memo_hit = 0
+        self._c_memo_miss = 0
+        self._c_store_hit = 0
+        self._c_store_miss = 0
+        for name in ["get_total", "get_err", "get_exc", "get_retry",
+                     "memo_hit", "memo_miss", "store_hit", "store_miss"]:
+            self._counters_total.setdefault(name, 0)
+    
+    @contextlib.contextmanager
+    def _fetching(self):
+        """
+        Context in which `_map` dispatches its calls to a bounded thread pool.
+        """
+        if not self._memo_shared:
+            self._memo.clear()
+        with _futures.ThreadPoolExecutor(max_workers=max(1, self._max_workers)) as executor:
+            self._executor = executor
+            try:
+                yield executor
+            finally:
+                self._executor = None
+    
+    def _detach_memo(self):
+        # Stop using a memo shared with other assignments (see
+        # `HeatmapCollection`), so that refreshes request everything again
+        if self._memo_shared:
+            self._memo = _fetch.RequestMemo()
+            self._memo_shared = False
+    
+    def init(self, sample=None):
+        for _ in self.stream(sample=sample):
+            pass
     
-    def init(self):
+    def stream(self, store=True, sample=None):
+        """
+        Initialize the data like `init`, but as a generator yielding the
+        `(comment_id, comment_obj)` pairs as soon as each enriched comment is
+        available (in no particular order), so that they can be aggregated
+        while the rest are being fetched (see `aggregate.HeatmapAccumulator`).
+        
+        With `store=False`, the comments are not kept in this object. See
+        `stream_rubric` for `sample`.
+        """
         # Data
         self._map_comments_id_to_cache = {}
         self._map_student_to_section = {}
         self._map_rubricComments_id_to_obj = {}
         self._map_rubricComments_id_to_category = {}
+        self._map_file_id_to_submission = {}
         
         # Statistics
-        self._c_get_total = 0
-        self._c_get_err = 0
-        self._c_get_exc = 0
+        self._reset_statistics()
         self._t_init_start = None
         self._t_init_start
         
         # Initialization
         self._t_init_start = time.time()
         
-        self.process_sections()
-        self.process_rubric()
+        with self._fetching():
+            with self._instrumentation.phase("process_sections"):
+                self.process_sections()
+            if self._prefetch:
+                with self._instrumentation.phase("process_submissions"):
+                    self.process_submissions()
+            with self._instrumentation.phase("process_rubric"):
+                for item in self.stream_rubric(store=store, sample=sample):
+                    yield item
         
         self._t_init_end = time.time()
         self._t_init_duration = (self._t_init_end - self._t_init_start)
     
-    def _get(self, endpoint, **kwargs):
-        r = None
-        try:
-            self._c_get_total += 1
-            r = _requests.get(
-                url=urljoin(_util.BASE_URL, endpoint),
-                headers=self._headers,
-                **kwargs
-            )
-        except:
-            self._c_get_exc += 1
-            return None
+    def get_progress(self):
+        """
+        Return the number of comments processed so far, and the total number
+        of comments to process (`None` until the rubric is known).
+        """
+        return (getattr(self, "_c_stream_done", 0), getattr(self, "_c_stream_total", None))
+    
+    def stats(self):
+        """
+        Return the statistics of this object: request counters, cache hit
+        ratios, durations, and the per-endpoint and per-phase statistics of
+        its instrumentation.
+        """
+        def ratio(hits, misses):
+            return hits / float(hits + misses) if hits + misses > 0 else None
+        
+        counters = dict(
+            (name[len("_c_"):], value)
+            for (name, value) in self.__dict__.items()
+            if name.startswith("_c_"))
+        
+        statistics = {
+            "assignment": self._assignment_id,
+            "comments": len(self._map_comments_id_to_cache),
+            "counters": counters,
+            "counters_total": dict(self._counters_total),
+            "memo_hit_ratio": ratio(counters.get("memo_hit", 0), counters.get("memo_miss", 0)),
+            "store_hit_ratio": ratio(counters.get("store_hit", 0), counters.get("store_miss", 0)),
+            "init_duration": getattr(self, "_t_init_duration", None),
+            "refresh_duration": getattr(self, "_t_refresh_duration", None),
+            "rate_limit": self._limiter.rate,
+        }
+        statistics.update(self._instrumentation.to_dict())
+        return statistics
+    
+    def export_stats(self, filename, format=None):
+        """
+        Write the statistics to a JSON file, or to a Prometheus text file
+        (`format="prometheus"`, the default for ".prom" files, e.g. for the
+        node exporter's textfile collector).
+        """
+        if format == None:
+            format = "prometheus" if filename.endswith(".prom") else "json"
+        
+        statistics = self.stats()
+        if format == "json":
+            content = json.dumps(statistics, indent=2, sort_keys=True)
+        elif format == "prometheus":
+            gauges = dict(
+                (name, value) for (name, value) in statistics.items()
+                if isinstance(value, (int, float)) and name != "assignment")
+            # The counters of the last initialization or refresh are reset by
+            # the next one: only the cumulative ones are exported as counters,
+            # and the others (sizes of the last run) as gauges
+            gauges.update(
+                (_gauge_name(name), value)
+                for (name, value) in statistics["counters"].items()
+                if name not in statistics["counters_total"])
+            content = self._instrumentation.to_prometheus(
+                labels={"assignment": self._assignment_id}, gauges=gauges,
+                counters=statistics["counters_total"])
+        else:
+            raise ValueError("Unknown statistics format: {}".format(format))
         
-        if r.status_code == 401:
-            raise Exception("Auth failed: API key missing or invalid,"
-                            " or does not have access to this ressource?")
+        # Written atomically, since the file is typically read periodically
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            f.write(content)
+        os.replace(tmp_filename, filename)
+    
+    def refresh(self, rubric_obj=None, sections=True):
+        """
+        Incrementally update the comments (typically loaded from the cache):
+        the sections and rubric are requested again, and only the comments
+        that were added to a rubric comment since are fetched; the comments
+        that no longer appear in the rubric are dropped.
+        
+        The rubric may be given (e.g. as returned by `poll_rubric`), and
+        with `sections=False` the sections are only requested if they were
+        not already (e.g. by a previous refresh).
+        """
+        self._reset_statistics()
+        self._c_refresh_added = 0
+        self._c_refresh_removed = 0
+        self._c_refresh_missing = 0
+        self._t_refresh_start = time.time()
+        
+        with self._fetching(), self._instrumentation.phase("refresh"):
+            if sections or len(getattr(self, "_map_student_to_section", {})) == 0:
+                self.process_sections()
+            
+            # The whole point is to catch up with the latest rubric
+            if rubric_obj == None:
+                rubric_obj = self._fetch_rubric()
+            
+            if self._prefetch:
+                # Submissions are only prefetched again if there are new comments
+                self._map_file_id_to_submission = {}
+            
+            self._process_rubric_categories(rubric_obj)
+            
+            cached = dict(self._map_comments_id_to_cache)
+            
+            tasks = []
+            for rubricComment_obj in self._process_rubric_comments(rubric_obj):
+                for comment_id in rubricComment_obj["comments"]:
+                    comment_obj = cached.get(comment_id)
+                    if comment_obj == None:
+                        tasks.append((comment_id, rubricComment_obj))
+                    else:
+                        # The rubric comment (text, category) may have been
+                        # edited, and students may have changed sections
+                        self._enrich_comment(comment_obj, rubricComment_obj)
+            
+            if self._prefetch and len(tasks) > 0:
+                self.process_submissions()
             
-        if r.status_code != 200:
-            self._c_get_err += 1
+            comment_objs = self._map(lambda task: self._process_comment(*task), tasks)
+            # Comments which cannot be fetched are left for the next refresh
+            new_comments = dict(
+                (comment_id, comment_obj)
+                for ((comment_id, _), comment_obj) in zip(tasks, comment_objs)
+                if comment_obj != None)
+        
+        # Rebuild the map in rubric order, dropping the deleted comments
+        self._map_comments_id_to_cache = {}
+        for rubricComment_obj in rubric_obj["rubricComments"]:
+            for comment_id in rubricComment_obj["comments"]:
+                comment_obj = new_comments.get(comment_id) or cached.get(comment_id)
+                if comment_obj != None:
+                    self._map_comments_id_to_cache[comment_id] = comment_obj
+        self._invalidate()
+        
+        self._c_refresh_added = len(new_comments)
+        self._c_refresh_removed = len(set(cached) - set(self._map_comments_id_to_cache))
+        self._c_refresh_missing = len(tasks) - len(new_comments)
+        
+        # Only now is the rubric applied (see `poll_rubric`)
+        self._commit_rubric_validators(rubric_obj)
+        
+        self._t_refresh_end = time.time()
+        self._t_refresh_duration = (self._t_refresh_end - self._t_refresh_start)
+        
+        _logger.debug("Refreshed assignment {}: {} comments added, {} removed".format(
+            self._assignment_id, self._c_refresh_added, self._c_refresh_removed))
+    
+    def poll_rubric(self):
+        """
+        Request the rubric again, conditionally: return it if it changed
+        since the previous call (or if this is the first call), or else
+        `None`.
+        
+        The validators of the previous response (`ETag`, `Last-Modified`)
+        are sent along, so that an unchanged rubric costs a 304 response
+        without a body; if the API does not provide them, the content is
+        compared by hash instead.
+        """
+        validators = getattr(self, "_rubric_validators", {})
+        headers = {}
+        if validators.get("etag") != None:
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified") != None:
+            headers["If-Modified-Since"] = validators["last_modified"]
+        
+        r = self._get("/assignments/{}/rubric/".format(self._assignment_id), headers=headers)
+        if r == None:
+            raise Exception("API Error: Cannot access rubric.")
+        
+        if r.status_code == 304:
+            return None
+        
+        response_validators = self._rubric_response_validators(r)
+        if response_validators["digest"] == validators.get("digest"):
+            # Same content as the applied rubric: its validators can be kept
+            self._rubric_validators = response_validators
             return None
+        
+        # The validators are only kept once the rubric is applied by a
+        # successful `refresh`, so that a failed one is tried again
+        rubric_obj = r.json()
+        self._rubric_pending = (rubric_obj, response_validators)
+        return rubric_obj
+    
+    @staticmethod
+    def _rubric_response_validators(r):
+        return {
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "digest": hashlib.sha256(r.content).hexdigest(),
+        }
+    
+    def _commit_rubric_validators(self, rubric_obj):
+        pending = getattr(self, "_rubric_pending", None)
+        if pending != None and pending[0] is rubric_obj:
+            self._rubric_validators = pending[1]
+            self._rubric_pending = None
+    
+    def update(self, sections=False):
+        """
+        Refresh the comments if the rubric changed since the previous call
+        (see `poll_rubric`), if the previous refresh could not fetch some of
+        them, or if only a sample was loaded, and return whether it did. Otherwise, this only costs a
+        (conditional) request.
+        """
+        rubric_obj = self.poll_rubric()
+        if rubric_obj == None and getattr(self, "_c_refresh_missing", 0) == 0:
+            return False
+        self.refresh(rubric_obj=rubric_obj, sections=sections)
+        return True
+    
+    def _count(self, counter, value=1):
+        # Counters are shared by all the worker threads of the fetch engine
+        with self._lock:
+            setattr(self, counter, getattr(self, counter, 0) + value)
+            name = counter[len("_c_"):]
+            self._counters_total[name] = self._counters_total.get(name, 0) + value
+    
+    def _map(self, func, iterable):
+        """
+        Apply `func` to every item of `iterable` using the bounded thread pool
+        of the current initialization (if any), and return the results in
+        the same order as the items.
+        """
+        executor = getattr(self, "_executor", None)
+        if executor == None or self._max_workers <= 1:
+            return list(map(func, iterable))
+        return list(executor.map(func, iterable))
+    
+    def _imap_unordered(self, func, iterable):
+        """
+        Like `_map`, but yield the results as soon as they are available, and
+        only submit a bounded number of items ahead to the thread pool.
+        """
+        executor = getattr(self, "_executor", None)
+        if executor == None or self._max_workers <= 1:
+            for item in iterable:
+                yield func(item)
+            return
+        
+        items = iter(iterable)
+        pending = set(
+            executor.submit(func, item)
+            for item in itertools.islice(items, 4 * self._max_workers))
+        
+        while len(pending) > 0:
+            (done, pending) = _futures.wait(pending, return_when=_futures.FIRST_COMPLETED)
+            pending |= set(
+                executor.submit(func, item)
+                for item in itertools.islice(items, len(done)))
+            for future in done:
+                yield future.result()
+    
+    def _get(self, endpoint, headers=None, **kwargs):
+        if headers != None:
+            headers = dict(self._headers, **headers)
         else:
+            headers = self._headers
+        
+        for attempt in range(self._max_retries + 1):
+            if attempt > 0:
+                self._count("_c_get_retry")
+            
+            self._limiter.acquire()
+            
+            r = None
+            self._instrumentation.before_request(endpoint)
+            t_start = time.time()
             try:
-                r.json()
+                self._count("_c_get_total")
+                r = self._session.get(
+                    url=urljoin(self._base_url or _util.BASE_URL, endpoint),
+                    headers=headers,
+                    **kwargs
+                )
             except:
-                self._c_get_err += 1
-                return None
+                self._instrumentation.after_request(endpoint, None, time.time() - t_start)
+                self._count("_c_get_exc")
+                if attempt == self._max_retries:
+                    return None
+                self._limiter.backoff()
+                time.sleep(_fetch.backoff_delay(attempt))
+                continue
+            
+            self._instrumentation.after_request(endpoint, r, time.time() - t_start)
             
-        return r
+            if r.status_code == 401:
+                raise Exception("Auth failed: API key missing or invalid,"
+                                " or does not have access to this ressource?")
+            
+            # Overloaded API: slow down and try again
+            if r.status_code in _fetch.RETRYABLE_STATUS_CODES:
+                if attempt == self._max_retries:
+                    break
+                _logger.debug("Got HTTP {} for '{}': backing off (attempt {})".format(
+                    r.status_code, endpoint, attempt + 1))
+                self._limiter.backoff()
+                time.sleep(_fetch.backoff_delay(
+                    attempt, retry_after=r.headers.get("Retry-After")))
+                continue
+            
+            # Not modified (conditional requests, see `poll_rubric`)
+            if r.status_code == 304:
+                self._limiter.recover()
+                return r
+            
+            if r.status_code != 200:
+                break
+            else:
+                try:
+                    r.json()
+                except:
+                    break
+            
+            self._limiter.recover()
+            return r
+        
+        self._count("_c_get_err")
+        return None
     
-    def _getjson(self, endpoint, **kwargs):
-        r = self._get(endpoint=endpoint, **kwargs)
-        return r.json()
+    def _getjson(self, endpoint, memoize=True, store=True, **kwargs):
+        if len(kwargs) > 0:
+            r = self._get(endpoint=endpoint, **kwargs)
+            return r.json() if r != None else None
+        
+        if not memoize:
+            return self._getjson_stored(endpoint, store=store)
+        
+        # Share the result of identical requests during this run (files and
+        # submissions are typically requested once per comment)
+        (obj, hit) = self._memo.get(
+            endpoint,
+            lambda: self._getjson_stored(endpoint, store=store))
+        self._count("_c_memo_hit" if hit else "_c_memo_miss")
+        return obj
+    
+    def _getjson_stored(self, endpoint, store=True, on_response=None):
+        store = self._store if store else None
+        
+        if store != None and store.ttl(endpoint) != None:
+            obj = store.get(endpoint)
+            if obj != None:
+                self._count("_c_store_hit")
+                return obj
+            self._count("_c_store_miss")
+        
+        r = self._get(endpoint=endpoint)
+        obj = r.json() if r != None else None
+        
+        if on_response != None and obj != None:
+            on_response(r, obj)
+        
+        if store != None and obj != None:
+            store.put(endpoint, obj)
+        
+        return obj
     
     def _get_comments_submission(self, comment_id=None, comment_obj=None):
         if comment_obj == None:
-            comment_obj = self._getjson("/comments/{}/".format(comment_id))
+            comment_obj = self._getjson("/comments/{}/".format(comment_id), memoize=False)
         
         file_id = comment_obj["file"]
+        
+        # Bulk-prefetched index (see process_submissions)
+        submission_obj = getattr(self, "_map_file_id_to_submission", {}).get(file_id)
+        if submission_obj != None:
+            return submission_obj
+        
         file_obj = self._getjson("/files/{}/".format(file_id))
+        if file_obj == None:
+            return None
         
         submission_id = file_obj["submission"]
         submission_obj = self._getjson("/submissions/{}/".format(submission_id))
@@ -149,24 +655,54 @@ class HeatmapData(object):
         course_id = assignment_obj["course"]
         course_obj = self._getjson("/courses/{}/".format(course_id))
         
-        for section_id in course_obj["sections"]:
-            section_obj = self._getjson("/sections/{}/".format(section_id))
+        section_objs = self._map(
+            lambda section_id: self._getjson("/sections/{}/".format(section_id)),
+            course_obj["sections"])
+        
+        for section_obj in section_objs:
             for student in section_obj["students"]:
                 self._map_student_to_section[student] = section_obj["name"]
     
-    def process_rubric(self):
-        a_id = self._assignment_id
+    def process_submissions(self):
+        """
+        Download all the submissions of the assignment in a single request,
+        and index them by file ID, so that the submission (and students) of
+        a comment can be resolved without requesting its file and submission.
+        """
+        self._map_file_id_to_submission = {}
+        
+        submission_objs = self._getjson(
+            "/assignments/{}/submissions/".format(self._assignment_id))
+        if submission_objs == None:
+            raise Exception("API Error: Cannot access submissions.")
+        
+        for submission_obj in submission_objs:
+            for file_obj in submission_obj.get("files", []):
+                # Files may be provided either as IDs or as objects
+                file_id = file_obj["id"] if isinstance(file_obj, dict) else file_obj
+                self._map_file_id_to_submission[file_id] = submission_obj
+    
+    def _fetch_rubric(self):
+        # Never from the response store: a stored copy may be stale and has
+        # no validators, the validators of the response are kept instead for
+        # the conditional requests of the next `poll_rubric`
+        def on_response(r, rubric_obj):
+            self._rubric_pending = (rubric_obj, self._rubric_response_validators(r))
         
-        rubric_obj = self._getjson("/assignments/{}/rubric/".format(a_id))
+        rubric_obj = self._getjson_stored(
+            "/assignments/{}/rubric/".format(self._assignment_id), store=False,
+            on_response=on_response)
         if rubric_obj == None:
             raise Exception("API Error: Cannot access rubric.")
-        
-        # Process rubric categories
-        self._map_comments_id_to_category = {}
+        return rubric_obj
+    
+    def _process_rubric_categories(self, rubric_obj):
+        self._map_rubricComments_id_to_category = {}
         for rubricCategory_obj in rubric_obj["rubricCategories"]:
             for rubricComments_id in rubricCategory_obj["rubricComments"]:
                 self._map_rubricComments_id_to_category[rubricComments_id] = rubricCategory_obj
-        
+    
+    def _process_rubric_comments(self, rubric_obj):
         # Process rubric comments
         #  {'id': 2335,
         #   'text': 'inverse performance: takes nlogn time to use a comparison based sort',
@@ -176,30 +712,201 @@ class HeatmapData(object):
         #   'sortKey': 0}
         
         self._map_rubricComments_id_to_obj = {}
-        self._map_comments_id_to_cache = {}
         for rubricComment_obj in rubric_obj["rubricComments"]:
             self._map_rubricComments_id_to_obj[rubricComment_obj["id"]] = rubricComment_obj
-            
-            # Get all the submission comments that are linked to the rubricComment
+        
+        return rubric_obj["rubricComments"]
+    
+    def process_rubric(self, sample=None):
+        for _ in self.stream_rubric(sample=sample):
+            pass
+    
+    def _sample_tasks(self, strata, sample):
+        # Stratified random sample of the comments linked to each rubric
+        # comment: the same fraction of each (at least one), either given or
+        # derived from a budget of comments
+        total = sum(len(comment_ids) for (_, comment_ids) in strata)
+        if isinstance(sample, float):
+            if not 0.0 < sample <= 1.0:
+                raise ValueError("The sample fraction must be in (0, 1]: {}".format(sample))
+            fraction = sample
+        else:
+            if sample < 1:
+                raise ValueError("The sample budget must be positive: {}".format(sample))
+            fraction = min(1.0, float(sample) / max(1, total))
+        
+        tasks = []
+        for (rubricComment_obj, comment_ids) in strata:
+            if len(comment_ids) == 0:
+                continue
+            n = min(len(comment_ids), max(1, int(math.ceil(fraction * len(comment_ids)))))
+            tasks += [ (comment_id, rubricComment_obj)
+                       for comment_id in random.sample(comment_ids, n) ]
+        
+        _logger.info("Sampling {} of the {} comments of assignment {}".format(
+            len(tasks), total, self._assignment_id))
+        return tasks
+    
+    def is_partial(self):
+        """
+        Return whether only a sample of the comments was loaded (see
+        `stream_rubric`), as the number of comments of some rubric comment is
+        lower than the number of comments linked to it; `refresh` fetches the
+        others.
+        """
+        counts = {}
+        populations = {}
+        for comment_obj in self._map_comments_id_to_cache.values():
+            rubricComment_obj = comment_obj["rubricComment"]
+            counts[rubricComment_obj["id"]] = counts.get(rubricComment_obj["id"], 0) + 1
+            populations[rubricComment_obj["id"]] = len(rubricComment_obj.get("comments", []))
+        return any(counts[key] < populations[key] for key in counts)
+    
+    def stream_rubric(self, store=True, sample=None):
+        """
+        Fetch the comments linked to the rubric comments (see `stream`).
+        
+        With `sample` (a fraction of the comments, or a budget of comments),
+        only a stratified random sample of the comments of each rubric
+        comment is fetched (at least one each), for a quick preview (see
+        `aggregate.estimate_heatmap`). The sample is kept like a full load
+        (in the cache as well): `refresh` later fetches the rest of the
+        comments.
+        """
+        rubric_obj = self._fetch_rubric()
+        
+        # Process rubric categories
+        self._process_rubric_categories(rubric_obj)
+        
+        self._map_comments_id_to_cache = {}
+        self._invalidate()
+        
+        # Get all the submission comments that are linked to the rubricComment
+        tasks = []
+        strata = []
+        for rubricComment_obj in self._process_rubric_comments(rubric_obj):
             linked_comment_ids = rubricComment_obj["comments"]
+            tasks += [ (comment_id, rubricComment_obj) for comment_id in linked_comment_ids ]
+            strata.append((rubricComment_obj, linked_comment_ids))
+        
+        if sample != None:
+            tasks = self._sample_tasks(strata, sample)
+        
+        self._c_stream_total = len(tasks)
+        self._c_stream_done = 0
+        
+        # Resume from the comments recorded by an interrupted initialization
+        journal = None
+        journaled = {}
+        if self._journal_filename != None:
+            journal = _cache.Journal(self._journal_filename)
+            journaled = journal.load()
+            if len(journaled) > 0:
+                _logger.info("Resuming: {} comments of assignment {} already fetched".format(
+                    len(journaled), self._assignment_id))
+        
+        def process(task):
+            (comment_id, rubricComment_obj) = task
+            
+            comment_obj = journaled.get(comment_id)
+            if comment_obj != None:
+                return (comment_id, self._enrich_comment(comment_obj, rubricComment_obj))
             
-            for comment_id in linked_comment_ids:
-                comment_obj = self._getjson("/comments/{}/".format(comment_id))
-                
-                # Enrich object
-                comment_obj["rubricComment"] = rubricComment_obj
-                category_obj = self._map_rubricComments_id_to_category.get(rubricComment_obj["id"], dict())
-                comment_obj["category"] = category_obj.get("name", "")
-                
-                submission_obj = self._get_comments_submission(comment_obj=comment_obj)
-                comment_obj["student"] = submission_obj["students"]
-                comment_obj["sections"] = list(
-                    filter(lambda x: x != None,
-                           map(lambda s: self._map_student_to_section.get(s, None),
-                              comment_obj["student"])))
-                
-                self._map_comments_id_to_cache[comment_id] = comment_obj
+            comment_obj = self._process_comment(comment_id, rubricComment_obj)
+            if journal != None and comment_obj != None:
+                journal.append(comment_id, comment_obj)
+            return (comment_id, comment_obj)
+        
+        # Fetch the comments (and their submissions) concurrently
+        failed_ids = []
+        try:
+            for (comment_id, comment_obj) in self._imap_unordered(process, tasks):
+                self._count("_c_stream_done")
+                if comment_obj == None:
+                    failed_ids.append(comment_id)
+                    continue
+                if store:
+                    self._map_comments_id_to_cache[comment_id] = comment_obj
+                yield (comment_id, comment_obj)
+        finally:
+            if journal != None:
+                journal.close()
+        
+        # The other comments are in the journal: a new attempt only needs to
+        # fetch these ones
+        if len(failed_ids) > 0:
+            raise Exception("API Error: Cannot access {} comments (e.g. {}).".format(
+                len(failed_ids), failed_ids[0]))
+        
+        # Insert them in the original order
+        if store:
+            self._map_comments_id_to_cache = dict(
+                (comment_id, self._map_comments_id_to_cache[comment_id])
+                for (comment_id, _) in tasks)
+            self._invalidate()
+            # A sample is not up to date with the rubric: the next `update`
+            # completes it
+            if sample == None:
+                self._commit_rubric_validators(rubric_obj)
+    
+    def _process_comment(self, comment_id, rubricComment_obj):
+        # Comments are only ever requested once, no need to memoize them
+        # Returns `None` if the comment cannot be fetched (after retries)
+        comment_obj = self._getjson("/comments/{}/".format(comment_id), memoize=False)
+        if comment_obj == None:
+            _logger.warning("Cannot access comment {}.".format(comment_id))
+            return None
+        
+        submission_obj = self._get_comments_submission(comment_obj=comment_obj)
+        if submission_obj == None:
+            _logger.warning("Cannot access the submission of comment {}.".format(comment_id))
+            return None
+        comment_obj["student"] = submission_obj["students"]
+        
+        return self._enrich_comment(comment_obj, rubricComment_obj)
+    
+    def _enrich_comment(self, comment_obj, rubricComment_obj):
+        # Enrich object
+        comment_obj["rubricComment"] = rubricComment_obj
+        category_obj = self._map_rubricComments_id_to_category.get(rubricComment_obj["id"], dict())
+        comment_obj["category"] = category_obj.get("name", "")
+        
+        comment_obj["sections"] = list(
+            filter(lambda x: x != None,
+                   map(lambda s: self._map_student_to_section.get(s, None),
+                      comment_obj["student"])))
+        
+        return comment_obj
+    
+    def snapshot(self):
+        """
+        Return a timestamped `snapshot.Snapshot` of the comments, to compare
+        with a later one (see `snapshot.diff`).
+        """
+        # The snapshots depend on numpy: imported here rather than with the
+        # package
+        from . import snapshot as _snapshot
+        return _snapshot.Snapshot.take(self)
     
     def get_comments(self):
+        """
+        Return a deep copy of the map of comment IDs to enriched comments,
+        which the caller is free to modify.
+        """
         return copy.deepcopy(self._map_comments_id_to_cache)
     
+    def view_comments(self):
+        """
+        Return a read-only view of the map of comment IDs to enriched
+        comments, without copying anything.
+        """
+        return types.MappingProxyType(self._map_comments_id_to_cache)
+    
+    def iter_comments(self):
+        """
+        Iterate over the `(comment_id, comment_obj)` pairs, where each
+        enriched comment is a read-only view (rather than a copy).
+        """
+        for (comment_id, comment_obj) in self._map_comments_id_to_cache.items():
+            yield (comment_id, types.MappingProxyType(comment_obj))
+    
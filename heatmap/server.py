@@ -0,0 +1,351 @@
+
+# Python dependencies
+#
+from __future__ import print_function # Python 2
+#
+import collections as collections
+import hashlib as hashlib
+import json as json
+import re as re
+import threading as threading
+import time as time
+
+try:
+    # Python 3
+    import http.server as _http_server
+    import socketserver as _socketserver
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    # Python 2
+    import BaseHTTPServer as _http_server
+    import SocketServer as _socketserver
+    from urlparse import urlparse, parse_qs
+
+# Local dependencies
+#
+from . import util as _util
+from . import draw as _draw
+from .preprocess import HeatmapData as HeatmapData
+from .aggregate import HeatmapXAxis as HeatmapXAxis
+from .aggregate import HeatmapYAxis as HeatmapYAxis
+from .aggregate import axis_from_value as _axis
+
+#########################################################################
+
+
+_logger = _util.getLogger()
+
+DEFAULT_PORT = 8050
+DEFAULT_MAX_ASSIGNMENTS = 16       # `HeatmapData` kept in memory
+DEFAULT_MAX_RENDERS = 256          # Rendered outputs kept in memory
+DEFAULT_REFRESH_INTERVAL = 300.0   # Seconds between two updates of an assignment
+
+CONTENT_TYPES = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+    "pdf": "application/pdf",
+    "json": "application/json",
+}
+
+_PATH_PATTERN = re.compile(r"^/heatmaps/(\d+)/(\w+)/(\w+)\.(\w+)$")
+
+#########################################################################
+
+
+class LRUCache(object):
+    """
+    Thread-safe map keeping only the `max_entries` most recently used
+    entries.
+    """
+
+    def __init__(self, max_entries):
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value != None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """
+        Insert `value`, and return the list of the evicted values.
+        """
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            evicted = []
+            while len(self._entries) > self._max_entries:
+                evicted.append(self._entries.popitem(last=False)[1])
+            return evicted
+
+    def values(self):
+        with self._lock:
+            return list(self._entries.values())
+
+def _json_label(label):
+    return list(label) if isinstance(label, tuple) else label
+
+class _Assignment(object):
+    # A warm `HeatmapData`, with the lock serializing its updates and reads
+    def __init__(self, hmapdata):
+        self.hmapdata = hmapdata
+        self.lock = threading.RLock()
+        self.t_updated = time.time()
+
+class HeatmapService(object):
+    """
+    Serves heatmaps (images and JSON matrices) of assignments: the
+    `HeatmapData` of the most recently requested assignments are kept in
+    memory (and updated every `refresh_interval` seconds, see
+    `HeatmapData.update`), and the rendered outputs are cached by a hash of
+    the counts and of the render options, so that a heatmap is only
+    rendered again when its data changed.
+
+    Additional keyword arguments are passed to each `HeatmapData`.
+    """
+
+    def __init__(self, max_assignments=DEFAULT_MAX_ASSIGNMENTS, max_renders=DEFAULT_MAX_RENDERS,
+                 refresh_interval=DEFAULT_REFRESH_INTERVAL, section_to_teacher=None, **kwargs):
+        self._assignments = LRUCache(max_assignments)
+        self._renders = LRUCache(max_renders)
+        self._refresh_interval = refresh_interval
+        self._section_to_teacher = section_to_teacher
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._loading = {}
+        # Drawing changes the global matplotlib/seaborn style: one at a time
+        self._render_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._refresher = None
+
+        self._c_render_hit = 0
+        self._c_render_miss = 0
+
+    def _assignment(self, assignment_id):
+        assignment = self._assignments.get(assignment_id)
+        if assignment != None:
+            return assignment
+
+        # Concurrent requests for the same assignment only load it once
+        with self._lock:
+            lock = self._loading.setdefault(assignment_id, threading.Lock())
+        with lock:
+            assignment = self._assignments.get(assignment_id)
+            if assignment == None:
+                _logger.info("Loading assignment {}".format(assignment_id))
+                assignment = _Assignment(HeatmapData(assignment_id=assignment_id, **self._kwargs))
+                self._assignments.put(assignment_id, assignment)
+        with self._lock:
+            self._loading.pop(assignment_id, None)
+        return assignment
+
+    def load(self, assignment_id):
+        """
+        Load an assignment ahead of the first request.
+        """
+        return self._assignment(assignment_id).hmapdata
+
+    def matrix(self, assignment_id, x, y):
+        assignment = self._assignment(assignment_id)
+        with assignment.lock:
+            return _draw.build_heatmap(
+                assignment.hmapdata, x=x, y=y,
+                section_to_teacher=self._section_to_teacher, format="matrix")
+
+    def get(self, assignment_id, x, y, format="png", annot=None, max_rows=None, dpi=100):
+        """
+        Return `(key, body)`: the heatmap of the assignment as an image (or
+        as JSON, with `format="json"`), and the key under which it is cached
+        (a hash of the counts and of the render options).
+        """
+        matrix = self.matrix(assignment_id, x, y)
+
+        options = [x.value, y.value, format, annot, max_rows, dpi]
+        if format == "json":
+            # Unlike images, the JSON matrices name their assignment
+            options.append(assignment_id)
+        key = hashlib.sha256(
+            (matrix.digest() + json.dumps(options)).encode("utf-8")).hexdigest()
+
+        body = self._renders.get(key)
+        # Requests are served by several threads
+        with self._lock:
+            if body != None:
+                self._c_render_hit += 1
+            else:
+                self._c_render_miss += 1
+        if body != None:
+            return (key, body)
+
+        if format == "json":
+            body = json.dumps({
+                "assignment": assignment_id,
+                "x": x.value,
+                "y": y.value,
+                "rows": [ _json_label(label) for label in matrix.row_labels ],
+                "cols": [ _json_label(label) for label in matrix.col_labels ],
+                "counts": matrix.counts.tolist(),
+                "digest": matrix.digest(),
+            }).encode("utf-8")
+        else:
+            with self._render_lock:
+                body = _draw.export_heatmap(
+                    matrix, format=format, x=x, y=y, annot=annot, max_rows=max_rows, dpi=dpi)
+
+        self._renders.put(key, body)
+        return (key, body)
+
+    def update(self):
+        """
+        Update the assignments which were not updated for `refresh_interval`
+        seconds (only a conditional request each, unless their rubric
+        changed).
+        """
+        for assignment in self._assignments.values():
+            if time.time() - assignment.t_updated < self._refresh_interval:
+                continue
+            with assignment.lock:
+                try:
+                    if assignment.hmapdata.update():
+                        _logger.info("Updated assignment {}".format(
+                            assignment.hmapdata._assignment_id))
+                        if self._kwargs.get("cache", True):
+                            assignment.hmapdata._store_cache(
+                                filename=self._kwargs.get("cache_filename"))
+                except Exception as exc:
+                    _logger.warning("Cannot update assignment {}: {}".format(
+                        assignment.hmapdata._assignment_id, exc))
+                assignment.t_updated = time.time()
+
+    def start(self):
+        """
+        Start updating the assignments in a background thread.
+        """
+        def run():
+            while not self._stopped.wait(min(self._refresh_interval, 10.0)):
+                self.update()
+
+        self._refresher = threading.Thread(target=run)
+        self._refresher.daemon = True
+        self._refresher.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "assignments": len(self._assignments),
+                "renders": len(self._renders),
+                "render_hit": self._c_render_hit,
+                "render_miss": self._c_render_miss,
+            }
+
+#########################################################################
+
+
+class _ThreadingHTTPServer(_socketserver.ThreadingMixIn, _http_server.HTTPServer):
+    daemon_threads = True
+
+def _make_handler(service):
+
+    class Handler(_http_server.BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            _logger.debug("{} {}".format(self.address_string(), format % args))
+
+        def _send(self, status, body, content_type="application/json", headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for (name, value) in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _error(self, status, message):
+            self._send(status, json.dumps({"error": message}).encode("utf-8"))
+
+        def do_GET(self):
+            url = urlparse(self.path)
+
+            if url.path == "/stats":
+                return self._send(200, json.dumps(service.stats()).encode("utf-8"))
+
+            match = _PATH_PATTERN.match(url.path)
+            if match == None:
+                return self._error(404, "Expected /heatmaps/<assignment>/<x>/<y>.<format>")
+
+            (assignment_id, x, y, format) = match.groups()
+            if format not in CONTENT_TYPES:
+                return self._error(404, "Unknown format: {}".format(format))
+            try:
+                x = _axis(HeatmapXAxis, x)
+                y = _axis(HeatmapYAxis, y)
+            except ValueError as exc:
+                return self._error(404, str(exc))
+
+            query = parse_qs(url.query)
+            try:
+                annot = query.get("annot", [None])[0]
+                max_rows = query.get("max_rows", [None])[0]
+                dpi = query.get("dpi", ["100"])[0]
+                options = dict(
+                    annot=None if annot == None else annot.lower() in ("1", "true", "yes"),
+                    max_rows=None if max_rows == None else int(max_rows),
+                    dpi=int(dpi))
+            except ValueError:
+                return self._error(400, "Invalid options: {}".format(url.query))
+
+            try:
+                (key, body) = service.get(int(assignment_id), x, y, format=format, **options)
+            except ValueError as exc:
+                # e.g. sectionsLeaders without a map of sections to teachers
+                return self._error(400, str(exc))
+            except Exception as exc:
+                _logger.warning("Cannot serve {}: {}".format(self.path, exc))
+                return self._error(500, str(exc))
+
+            # The key only changes with the data: clients can revalidate
+            etag = '"{}"'.format(key)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self._send(200, body, content_type=CONTENT_TYPES[format], headers={"ETag": etag})
+
+    return Handler
+
+def make_server(service, host="127.0.0.1", port=DEFAULT_PORT):
+    """
+    Return an HTTP server for `service` (call its `serve_forever`), serving
+    `/heatmaps/<assignment>/<x>/<y>.<png|svg|pdf|json>` (with the optional
+    `annot`, `max_rows` and `dpi` query parameters) and `/stats`.
+    """
+    return _ThreadingHTTPServer((host, port), _make_handler(service))
+
+def serve(host="127.0.0.1", port=DEFAULT_PORT, assignment_ids=(), **kwargs):
+    """
+    Run a `HeatmapService` (created with `kwargs`) until interrupted,
+    loading `assignment_ids` beforehand.
+    """
+    service = HeatmapService(**kwargs)
+    for assignment_id in assignment_ids:
+        service.load(assignment_id)
+    service.start()
+
+    server = make_server(service, host=host, port=port)
+    _logger.info("Serving heatmaps on http://{}:{}/".format(host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    finally:
+        service.stop()
+        server.server_close()
@@ -0,0 +1,184 @@
+
+# Python dependencies
+#
+from __future__ import print_function # Python 2
+#
+import json as json
+import time as time
+
+# External dependencies
+#
+import numpy as _np
+
+# Local dependencies
+#
+from . import util as _util
+from . import aggregate as _aggregate
+from .aggregate import HeatmapXAxis as HeatmapXAxis
+from .aggregate import HeatmapYAxis as HeatmapYAxis
+
+#########################################################################
+
+
+_logger = _util.getLogger()
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+_ARRAYS = ["comment_ids", "grader", "rubric_comment", "category", "section_comment", "section"]
+
+#########################################################################
+
+
+class Snapshot(object):
+    """
+    Timestamped state of the comments of an assignment: their IDs and
+    grader, section and rubric comment (and category) codes, as
+    `CommentCodes`. Snapshots are cheap to take (see `HeatmapData.snapshot`)
+    and to store, and two of them can be compared with `diff`.
+    """
+
+    def __init__(self, codes, assignment_id=None, timestamp=None):
+        self.codes = codes
+        self.assignment_id = assignment_id
+        self.timestamp = timestamp if timestamp != None else time.time()
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def take(cls, hmapdata):
+        return cls(
+            _aggregate.comment_codes(hmapdata),
+            assignment_id=hmapdata._assignment_id)
+
+    def heatmap(self, x=HeatmapXAxis.GRADERS, y=HeatmapYAxis.COMMENTS,
+                section_to_teacher=None, sparse=False):
+        """
+        Return the heatmap of the comments at the time of the snapshot.
+        """
+        return _aggregate.build_heatmap_matrix(
+            self.codes, x=x, y=y, section_to_teacher=section_to_teacher, sparse=sparse)
+
+    def save(self, filename):
+        """
+        Store the snapshot as a (compressed) NumPy `.npz` file.
+        """
+        meta = {
+            "version": SNAPSHOT_FORMAT_VERSION,
+            "assignment": self.assignment_id,
+            "timestamp": self.timestamp,
+            "graders": self.codes.graders,
+            "rubricComments": [ list(label) for label in self.codes.rubric_comments ],
+            "categories": self.codes.categories,
+            "sections": self.codes.sections,
+        }
+        arrays = dict((name, getattr(self.codes, name)) for name in _ARRAYS)
+        with open(filename, "wb") as f:
+            _np.savez_compressed(f, meta=_np.array(json.dumps(meta)), **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        with _np.load(filename, allow_pickle=False) as npz:
+            meta = json.loads(str(npz["meta"]))
+            if meta.get("version") != SNAPSHOT_FORMAT_VERSION:
+                raise ValueError("Unsupported snapshot format version: {}".format(
+                    meta.get("version")))
+            arrays = dict((name, npz[name]) for name in _ARRAYS)
+
+        codes = _aggregate.CommentCodes(
+            graders=meta["graders"],
+            rubric_comments=[ tuple(label) for label in meta["rubricComments"] ],
+            categories=meta["categories"],
+            sections=meta["sections"],
+            **arrays)
+        return cls(codes, assignment_id=meta["assignment"], timestamp=meta["timestamp"])
+
+#########################################################################
+
+
+def _section_changes(codes, old_index, new_index):
+    # Positions (in `old_index`/`new_index`, which pair the same comments)
+    # of the comments whose sections differ, comparing them as multisets
+    n_sections = max(1, len(codes.sections))
+
+    keys = []
+    for index in (old_index, new_index):
+        position = _np.full(len(codes), -1, dtype=_np.int64)
+        position[index] = _np.arange(len(index), dtype=_np.int64)
+        pair_position = position[codes.section_comment]
+        keep = pair_position >= 0
+        (unique_keys, counts) = _np.unique(
+            pair_position[keep] * n_sections + codes.section[keep], return_counts=True)
+        keys.append((unique_keys, counts))
+
+    n_counts = 1 + max([ int(counts.max()) for (_, counts) in keys if len(counts) > 0 ] or [0])
+    (old_keys, new_keys) = [
+        unique_keys * n_counts + counts for (unique_keys, counts) in keys ]
+    changed = _np.setxor1d(old_keys, new_keys, assume_unique=True)
+    return _np.unique(changed // n_counts // n_sections)
+
+class SnapshotDiff(object):
+    """
+    Difference between two snapshots: the IDs of the comments that were
+    `added`, `removed` and `modified` (e.g. a different rubric comment, or
+    rubric comment text), and `delta`, the heatmap of the difference.
+    """
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+
+        # Both snapshots with the same labels: the old comments come first
+        codes = _aggregate.CommentCodes.concatenate([old.codes, new.codes])
+        n_old = len(old)
+        old_ids = codes.comment_ids[:n_old]
+        new_ids = codes.comment_ids[n_old:]
+
+        (_, old_common, new_common) = _np.intersect1d(
+            old_ids, new_ids, assume_unique=True, return_indices=True)
+        new_common = new_common + n_old
+
+        modified = (
+            (codes.grader[old_common] != codes.grader[new_common]) |
+            (codes.rubric_comment[old_common] != codes.rubric_comment[new_common]) |
+            (codes.category[old_common] != codes.category[new_common]))
+        modified[_section_changes(codes, old_common, new_common)] = True
+
+        removed = _np.setdiff1d(_np.arange(n_old), old_common, assume_unique=True)
+        added = _np.setdiff1d(_np.arange(n_old, len(codes)), new_common, assume_unique=True)
+
+        self.added = codes.comment_ids[added]
+        self.removed = codes.comment_ids[removed]
+        self.modified = codes.comment_ids[old_common[modified]]
+
+        # Only the comments which changed are counted, negatively for their
+        # old state and positively for their new state
+        minus = _np.concatenate([removed, old_common[modified]])
+        plus = _np.concatenate([added, new_common[modified]])
+        self._codes = codes.take(_np.concatenate([minus, plus]))
+        self._weights = _np.concatenate([
+            _np.full(len(minus), -1, dtype=_np.int64),
+            _np.ones(len(plus), dtype=_np.int64)])
+
+    def __len__(self):
+        # Number of changed comments
+        return len(self.added) + len(self.removed) + len(self.modified)
+
+    def delta(self, x=HeatmapXAxis.GRADERS, y=HeatmapYAxis.COMMENTS,
+              section_to_teacher=None, sparse=False):
+        """
+        Return the heatmap of the new snapshot minus the heatmap of the old
+        one (with signed counts), computed from the changed comments only;
+        plot it with `render_heatmap_data(..., diverging=True)`.
+        """
+        (comment_index, x_code, x_labels) = self._codes.x_pairs(x, section_to_teacher)
+        (y_code, y_labels) = self._codes.y_codes(y)
+        return _aggregate._heatmap_from_pairs(
+            y_code[comment_index], x_code, y_labels, x_labels,
+            weights=self._weights[comment_index], sparse=sparse)
+
+def diff(old, new):
+    """
+    Compare two snapshots (`old` is typically the older one).
+    """
+    return SnapshotDiff(old, new)
@@ -0,0 +1,218 @@
+
+# Python dependencies
+#
+from __future__ import print_function # Python 2
+#
+import bisect as bisect
+import contextlib as contextlib
+import re as re
+import threading as threading
+import time as time
+
+# Local dependencies
+#
+from . import util as _util
+
+#########################################################################
+
+
+_logger = _util.getLogger()
+
+# Upper bounds (in seconds) of the buckets of the latency histograms
+DEFAULT_LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#########################################################################
+
+
+def endpoint_pattern(endpoint):
+    """
+    Return the endpoint with its object IDs replaced by `{id}`, so that all
+    the requests to the same kind of object are accounted together.
+    """
+    return re.sub(r"/\d+(?=/|$)", "/{id}", endpoint)
+
+class Instrumentation(object):
+    """
+    Collects per-endpoint request statistics (counts, errors, latency
+    histograms, bytes transferred) and the duration of named phases (see
+    `phase`), and calls the hooks registered with `add_hook` around every
+    request.
+    """
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self._buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._hooks = []
+        self.reset()
+
+    def __getstate__(self):
+        # Hooks are typically closures, which cannot be pickled
+        state = self.__dict__.copy()
+        state.pop("_lock", None)
+        state["_hooks"] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+            self._phases = {}
+
+    def add_hook(self, before=None, after=None):
+        """
+        Register callbacks around every request: `before(endpoint)` and
+        `after(endpoint, response, duration)`, where `response` is `None` if
+        the request raised an exception.
+        """
+        self._hooks.append((before, after))
+
+    def before_request(self, endpoint):
+        for (before, _) in self._hooks:
+            if before != None:
+                before(endpoint)
+
+    def after_request(self, endpoint, response, duration):
+        for (_, after) in self._hooks:
+            if after != None:
+                after(endpoint, response, duration)
+
+        status = response.status_code if response != None else None
+        size = len(response.content) if response != None else 0
+        self.record_request(endpoint, status, duration, size)
+
+    def record_request(self, endpoint, status, duration, size):
+        pattern = endpoint_pattern(endpoint)
+        with self._lock:
+            entry = self._endpoints.get(pattern)
+            if entry == None:
+                entry = {
+                    "count": 0,
+                    "errors": 0,
+                    "bytes": 0,
+                    "duration": 0.0,
+                    "buckets": [0] * (len(self._buckets) + 1),
+                }
+                self._endpoints[pattern] = entry
+            entry["count"] += 1
+            entry["errors"] += 0 if status in (200, 304) else 1
+            entry["bytes"] += size
+            entry["duration"] += duration
+            entry["buckets"][bisect.bisect_left(self._buckets, duration)] += 1
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context measuring the duration of a phase (which may run several
+        times, e.g. `build_heatmap`).
+        """
+        t_start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - t_start
+            with self._lock:
+                entry = self._phases.setdefault(name, {"count": 0, "duration": 0.0})
+                entry["count"] += 1
+                entry["duration"] += duration
+
+    def to_dict(self):
+        with self._lock:
+            endpoints = {}
+            for (pattern, entry) in self._endpoints.items():
+                endpoints[pattern] = {
+                    "count": entry["count"],
+                    "errors": entry["errors"],
+                    "bytes": entry["bytes"],
+                    "duration": entry["duration"],
+                    "mean_duration": entry["duration"] / entry["count"],
+                    "histogram": dict(zip(
+                        [ str(b) for b in self._buckets ] + ["+Inf"],
+                        entry["buckets"])),
+                }
+            phases = dict(
+                (name, dict(entry)) for (name, entry) in self._phases.items())
+        return {"requests": endpoints, "phases": phases}
+
+    def to_prometheus(self, labels=None, gauges=None, counters=None):
+        """
+        Return the statistics in the Prometheus text exposition format, with
+        the additional `labels` on every sample, and the additional `gauges`
+        and `counters` (maps of metric names to values; "_total" is appended
+        to the names of the counters which do not end with it).
+        """
+        def format_labels(**extra):
+            items = list((labels or {}).items()) + list(extra.items())
+            if len(items) == 0:
+                return ""
+            return "{" + ",".join(
+                '{}="{}"'.format(key, str(value).replace('"', '\\"'))
+                for (key, value) in items) + "}"
+
+        lines = []
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            phases = sorted(self._phases.items())
+
+            # Samples of the same metric must be grouped together
+            for (metric, key) in [("requests_total", "count"),
+                                  ("request_errors_total", "errors"),
+                                  ("response_bytes_total", "bytes")]:
+                lines.append("# TYPE heatmap_{} counter".format(metric))
+                for (pattern, entry) in endpoints:
+                    lines.append("heatmap_{}{} {}".format(
+                        metric, format_labels(endpoint=pattern), entry[key]))
+
+            lines.append("# TYPE heatmap_request_duration_seconds histogram")
+            for (pattern, entry) in endpoints:
+                cumulative = 0
+                for (bound, count) in zip(list(self._buckets) + ["+Inf"], entry["buckets"]):
+                    cumulative += count
+                    lines.append("heatmap_request_duration_seconds_bucket{} {}".format(
+                        format_labels(endpoint=pattern, le=bound), cumulative))
+                lines.append("heatmap_request_duration_seconds_sum{} {}".format(
+                    format_labels(endpoint=pattern), entry["duration"]))
+                lines.append("heatmap_request_duration_seconds_count{} {}".format(
+                    format_labels(endpoint=pattern), entry["count"]))
+
+            for (metric, key) in [("phase_duration_seconds_total", "duration"),
+                                  ("phase_runs_total", "count")]:
+                lines.append("# TYPE heatmap_{} counter".format(metric))
+                for (name, entry) in phases:
+                    lines.append("heatmap_{}{} {}".format(
+                        metric, format_labels(phase=name), entry[key]))
+
+        for (name, value) in sorted((gauges or {}).items()):
+            if value == None:
+                continue
+            lines.append("# TYPE heatmap_{} gauge".format(name))
+            lines.append("heatmap_{}{} {}".format(name, format_labels(), float(value)))
+
+        for (name, value) in sorted((counters or {}).items()):
+            if value == None:
+                continue
+            if not name.endswith("_total"):
+                name = "{}_total".format(name)
+            lines.append("# TYPE heatmap_{} counter".format(name))
+            lines.append("heatmap_{}{} {}".format(name, format_labels(), float(value)))
+
+        return "\n".join(lines) + "\n"
+
+#########################################################################
+
+
+def phase(obj, name):
+    """
+    Return the `phase` context of the instrumentation of `obj` (typically a
+    `HeatmapData`), or a context doing nothing if it is not instrumented.
+    """
+    instrumentation = getattr(obj, "_instrumentation", obj)
+    if isinstance(instrumentation, Instrumentation):
+        return instrumentation.phase(name)
+    return _null_context()
+
+@contextlib.contextmanager
+def _null_context():
+    yield
@@ -102,23 +102,34 @@ class SimpleColorFormatter(logging.Formatter):
             msg.message
         ))
 
-def _setupLogging(level="INFO"):
+def setupLogging(level="INFO"):
+    """
+    Print the log records of the package on the terminal, in color (e.g.
+    for scripts and the command line). Otherwise, the records go to the
+    logging configured by the application.
+    """
 
     # Add the color handler to the terminal output
     handler = logging.StreamHandler()
     formatter = SimpleColorFormatter()
     handler.setFormatter(formatter)
 
-    # Set logging level
-    root = logging.getLogger()
-    root.setLevel(os.environ.get("LOGLEVEL", level))
+    # Only configure the package's logger: the root logger (and thus the
+    # logging of other libraries) belongs to the application
+    logger = logging.getLogger(__name__.split(".")[0])
+    logger.setLevel(os.environ.get("LOGLEVEL", level))
+    logger.propagate = False
 
     # Add the color handler to the logger
-    root.addHandler(handler)
+    if not any(isinstance(h, logging.StreamHandler) for h in logger.handlers):
+        logger.addHandler(handler)
 
-    return root
+    return logger
 
-_logger = _setupLogging()
+# Importing the package has no logging side effect: handlers, levels and
+# propagation are left to the application (see `setupLogging`)
+_logger = logging.getLogger(__name__.split(".")[0])
+_logger.addHandler(logging.NullHandler())
 
 def getLogger():
     return _logger
@@ -210,4 +221,9 @@ class DocEnum(_Enum):
         self._value_ = value
         self.__doc__ = doc
 
+    def __reduce_ex__(self, proto):
+        # Members cannot be looked up by value (the value is only set after
+        # the enum is created), so they are pickled by name
+        return (getattr, (self.__class__, self.name))
+
 #########################################################################